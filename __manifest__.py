@@ -1,6 +1,6 @@
 {
     'name': 'Shopify Integration',
-    'version': '16.0.1.0.0',
+    'version': '16.0.1.1.0',
     'category': 'Sales/E-commerce',
     'summary': 'Complete Shopify integration for Odoo',
     'description': """
@@ -28,16 +28,12 @@ class ShopifyWebhookController(http.Controller):
         return hmac.compare_digest(calculated_hmac, hmac_header)
 
     def _get_instance_from_domain(self, shop_domain):
-        """Get Shopify instance from shop domain"""
-        instance = request.env['shopify.instance'].sudo().search([
-            ('shop_url', '=', shop_domain),
-            ('is_active', '=', True)
-        ], limit=1)
-        return instance
-
-    @http.route('/shopify/webhook/<string:topic>', type='json', auth='public', methods=['POST'], csrf=False)
+        """Get the cached webhook configuration of the instance of ``shop_domain``"""
+        return request.env['shopify.instance'].sudo()._get_webhook_config(shop_domain)
+
+    @http.route('/shopify/webhook/<path:topic>', type='http', auth='public', methods=['POST'], csrf=False)
     def shopify_webhook(self, topic, **kwargs):
-        """Generic webhook handler"""
+        """Generic webhook handler, storing the verified delivery in the inbox"""
         try:
             # Get request data
             data = request.httprequest.get_data()
@@ -49,75 +45,81 @@ class ShopifyWebhookController(http.Controller):
 
             if not shop_domain:
                 _logger.error("Missing X-Shopify-Shop-Domain header")
-                return {'status': 'error', 'message': 'Missing shop domain'}
+                return self._response(400, 'Missing shop domain')
 
             # Find instance
-            instance = self._get_instance_from_domain(shop_domain)
-            if not instance:
+            config = self._get_instance_from_domain(shop_domain)
+            if not config or not config[2]:
                 _logger.error(f"No active instance found for domain: {shop_domain}")
-                return {'status': 'error', 'message': 'Unknown shop domain'}
+                return self._response(404, 'Unknown shop domain')
+            instance_id, webhook_secret, active, coalesce_window = config
 
             # Verify signature
-            if instance.webhook_secret and not self._verify_webhook_signature(data, hmac_header, instance.webhook_secret):
+            if webhook_secret and not self._verify_webhook_signature(data, hmac_header or '', webhook_secret):
                 _logger.error(f"Invalid webhook signature for {shop_domain}")
-                return {'status': 'error', 'message': 'Invalid signature'}
-
-            # Parse JSON data
-            webhook_data = json.loads(data.decode('utf-8'))
-
-            # Process webhook
-            result = request.env['shopify.webhook'].sudo().process_webhook(
-                topic.replace('/', '/'),  # Ensure proper topic format
-                webhook_data,
-                dict(headers),
-                instance.id
+                return self._response(401, 'Invalid signature')
+
+            # Processing happens asynchronously, so that Shopify gets its
+            # response well within the delivery timeout
+            delivery = request.env['shopify.webhook.inbox'].sudo()._enqueue(
+                instance_id,
+                headers.get('X-Shopify-Topic') or topic,
+                data.decode('utf-8'),
+                {name: value for name, value in headers.items() if name.startswith('X-Shopify-')},
+                coalesce_window=coalesce_window
             )
-
-            if result:
-                return {'status': 'success', 'message': 'Webhook processed'}
-            else:
-                return {'status': 'error', 'message': 'Webhook processing failed'}
+            if not delivery:
+                return self._response(200, 'Duplicate webhook ignored')
+            return self._response(200, 'Webhook received')
 
         except Exception as e:
-            _logger.error(f"Error processing webhook {topic}: {str(e)}")
-            return {'status': 'error', 'message': str(e)}
+            _logger.error(f"Error receiving webhook {topic}: {str(e)}")
+            return self._response(500, str(e))
+
+    def _response(self, status, message):
+        """Return a JSON response with ``status``"""
+        return Response(
+            json.dumps({'status': 'success' if status == 200 else 'error', 'message': message}),
+            status=status,
+            content_type='application/json'
+        )
 
-    @http.route('/shopify/webhook/order/create', type='json', auth='public', methods=['POST'], csrf=False)
+    @http.route('/shopify/webhook/order/create', type='http', auth='public', methods=['POST'], csrf=False)
     def order_create(self, **kwargs):
         """Handle order creation webhook"""
         return self.shopify_webhook('orders/create', **kwargs)
 
-    @http.route('/shopify/webhook/order/update', type='json', auth='public', methods=['POST'], csrf=False)
+    @http.route('/shopify/webhook/order/update', type='http', auth='public', methods=['POST'], csrf=False)
     def order_update(self, **kwargs):
         """Handle order update webhook"""
         return self.shopify_webhook('orders/updated', **kwargs)
 
-    @http.route('/shopify/webhook/order/cancel', type='json', auth='public', methods=['POST'], csrf=False)
+    @http.route('/shopify/webhook/order/cancel', type='http', auth='public', methods=['POST'], csrf=False)
     def order_cancel(self, **kwargs):
         """Handle order cancellation webhook"""
         return self.shopify_webhook('orders/cancelled', **kwargs)
 
-    @http.route('/shopify/webhook/order/fulfill', type='json', auth='public', methods=['POST'], csrf=False)
+    @http.route('/shopify/webhook/order/fulfill', type='http', auth='public', methods=['POST'], csrf=False)
     def order_fulfill(self, **kwargs):
         """Handle order fulfillment webhook"""
         return self.shopify_webhook('orders/fulfilled', **kwargs)
 
-    @http.route('/shopify/webhook/product/create', type='json', auth='public', methods=['POST'], csrf=False)
+    @http.route('/shopify/webhook/product/create', type='http', auth='public', methods=['POST'], csrf=False)
     def product_create(self, **kwargs):
         """Handle product creation webhook"""
         return self.shopify_webhook('products/create', **kwargs)
 
-    @http.route('/shopify/webhook/product/update', type='json', auth='public', methods=['POST'], csrf=False)
+    @http.route('/shopify/webhook/product/update', type='http', auth='public', methods=['POST'], csrf=False)
     def product_update(self, **kwargs):
         """Handle product update webhook"""
         return self.shopify_webhook('products/update', **kwargs)
 
-    @http.route('/shopify/webhook/customer/create', type='json', auth='public', methods=['POST'], csrf=False)
+    @http.route('/shopify/webhook/customer/create', type='http', auth='public', methods=['POST'], csrf=False)
     def customer_create(self, **kwargs):
         """Handle customer creation webhook"""
         return self.shopify_webhook('customers/create', **kwargs)
 
-    @http.route('/shopify/webhook/refund/create', type='json', auth='public', methods=['POST'], csrf=False)
+    @http.route('/shopify/webhook/refund/create', type='http', auth='public', methods=['POST'], csrf=False)
     def refund_create(self, **kwargs):
         """Handle refund creation webhook"""
         return self.shopify_webhook('refunds/create', **kwargs)
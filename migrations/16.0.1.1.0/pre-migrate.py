@@ -0,0 +1,62 @@
+import logging
+
+from odoo.tools.sql import table_exists
+
+_logger = logging.getLogger(__name__)
+
+# (table, scope column, columns referencing the table), parents before children
+# so that re-pointed children are deduplicated afterwards.
+DEDUPLICATIONS = [
+    ('shopify_product', 'instance_id', [
+        ('shopify_product_variant', 'product_id'),
+        ('shopify_product_image', 'product_id'),
+    ]),
+    ('shopify_customer', 'instance_id', [
+        ('shopify_customer_address', 'customer_id'),
+        ('shopify_order', 'customer_id'),
+    ]),
+    ('shopify_order', 'instance_id', [
+        ('shopify_order_line', 'order_id'),
+    ]),
+    ('shopify_product_variant', 'product_id', [
+        ('shopify_order_line', 'variant_id'),
+    ]),
+    ('shopify_product_image', 'product_id', []),
+    ('shopify_order_line', 'order_id', []),
+    ('shopify_customer_address', 'customer_id', []),
+]
+
+
+def _deduplicate(cr, table, scope, references):
+    """Merge rows sharing (scope, shopify_id) into the most recently written one"""
+    cr.execute(f"""
+        CREATE TEMP TABLE shopify_duplicates AS
+        SELECT id, keep_id FROM (
+            SELECT id, first_value(id) OVER (
+                PARTITION BY {scope}, shopify_id
+                ORDER BY write_date DESC NULLS LAST, id DESC
+            ) AS keep_id
+            FROM {table}
+            WHERE shopify_id <> ''
+        ) ranked
+        WHERE id <> keep_id
+    """)
+    for ref_table, ref_column in references:
+        if table_exists(cr, ref_table):
+            cr.execute(f"""
+                UPDATE {ref_table} ref
+                SET {ref_column} = dup.keep_id
+                FROM shopify_duplicates dup
+                WHERE ref.{ref_column} = dup.id
+            """)
+    cr.execute(f"DELETE FROM {table} t USING shopify_duplicates dup WHERE t.id = dup.id")
+    if cr.rowcount:
+        _logger.info("Removed %s duplicate rows from %s", cr.rowcount, table)
+    cr.execute("DROP TABLE shopify_duplicates")
+
+
+def migrate(cr, version):
+    """Remove duplicate Shopify mappings before the unique indexes are created"""
+    for table, scope, references in DEDUPLICATIONS:
+        if table_exists(cr, table):
+            _deduplicate(cr, table, scope, references)
@@ -1,5 +1,11 @@
+from . import shopify_mapping
 from . import shopify_instance
+from . import shopify_sync_cursor
 from . import shopify_product
+from . import shopify_location
+from . import shopify_stock
+from . import stock_move
+from . import product
 from . import shopify_order
 from . import shopify_customer
 from . import shopify_webhook
@@ -0,0 +1,32 @@
+from odoo import models
+
+# Product fields exported to Shopify: changing them marks the linked
+# Shopify products for the next export
+SHOPIFY_TEMPLATE_FIELDS = {'name', 'description_sale', 'default_code', 'barcode'}
+SHOPIFY_PRODUCT_FIELDS = {'name', 'default_code', 'barcode', 'product_template_attribute_value_ids'}
+# Price fields only mark the products for the next price sync
+SHOPIFY_PRICE_FIELDS = {'list_price', 'lst_price', 'price_extra'}
+
+
+class ProductTemplate(models.Model):
+    _inherit = 'product.template'
+
+    def write(self, vals):
+        res = super().write(vals)
+        if SHOPIFY_TEMPLATE_FIELDS.intersection(vals):
+            self.env['shopify.product']._mark_sync_required(self)
+        if SHOPIFY_PRICE_FIELDS.intersection(vals):
+            self.env['shopify.product']._mark_sync_required(self, 'price_sync_required')
+        return res
+
+
+class ProductProduct(models.Model):
+    _inherit = 'product.product'
+
+    def write(self, vals):
+        res = super().write(vals)
+        if SHOPIFY_PRODUCT_FIELDS.intersection(vals):
+            self.env['shopify.product']._mark_sync_required(self.product_tmpl_id)
+        if SHOPIFY_PRICE_FIELDS.intersection(vals):
+            self.env['shopify.product']._mark_sync_required(self.product_tmpl_id, 'price_sync_required')
+        return res
@@ -0,0 +1,371 @@
+import logging
+import threading
+import time
+from datetime import datetime, timezone
+
+import psycopg2
+import requests
+from requests.adapters import HTTPAdapter
+
+from odoo import _
+from odoo.exceptions import UserError
+
+_logger = logging.getLogger(__name__)
+
+API_VERSION = '2023-10'
+
+# Requests kept free in the bucket so concurrent workers do not overshoot it
+BUCKET_SAFETY_MARGIN = 2
+# Shopify leaks one request per second for every 20 slots of bucket capacity
+BUCKET_LEAK_DIVISOR = 20.0
+MAX_THROTTLE_RETRIES = 5
+DEFAULT_RETRY_AFTER = 2.0
+# Default GraphQL cost bucket of a standard shop, until Shopify reports it
+GRAPHQL_MAX_COST = 1000.0
+GRAPHQL_RESTORE_RATE = 50.0
+# Minimum delay between two readings of the bucket stored for other workers
+USAGE_REPORT_INTERVAL = 5.0
+
+# One pooled session per instance and per worker process, keyed on everything
+# that ends up in the connection or the auth headers so credential changes
+# transparently get a fresh session.
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def _get_session(key, pool_size, headers):
+    """Return the shared keep-alive session for ``key``, creating it if needed"""
+    with _sessions_lock:
+        session = _sessions.get(key)
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+            session.mount('https://', adapter)
+            session.headers.update(headers)
+            _sessions[key] = session
+        return session
+
+
+class LeakyBucket:
+    """Mirror of the Shopify REST leaky bucket of one shop, pacing the threads of this worker"""
+
+    def __init__(self, capacity=40):
+        self.capacity = capacity
+        self.level = 0.0
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self.reported = 0.0
+        self.lock = threading.Lock()
+
+    @property
+    def leak_rate(self):
+        return self.capacity / BUCKET_LEAK_DIVISOR
+
+    def _leak(self, now):
+        self.level = max(0.0, self.level - (now - self.updated) * self.leak_rate)
+        self.updated = now
+
+    def acquire(self):
+        """Block until one call can be sent without overflowing the bucket"""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self._leak(now)
+                ceiling = self.capacity - BUCKET_SAFETY_MARGIN
+                if now < self.blocked_until:
+                    wait = self.blocked_until - now
+                elif self.level + 1 <= ceiling:
+                    self.level += 1
+                    return
+                else:
+                    wait = (self.level + 1 - ceiling) / self.leak_rate
+            time.sleep(wait)
+
+    def update(self, header):
+        """Synchronise with a ``X-Shopify-Shop-Api-Call-Limit`` value (``used/capacity``)"""
+        try:
+            used, capacity = (int(part) for part in header.split('/'))
+        except (AttributeError, ValueError):
+            return
+        with self.lock:
+            self.capacity = capacity
+            self.level = float(used)
+            self.updated = time.monotonic()
+
+    def backoff(self, seconds):
+        """Hold every caller for ``seconds`` after a 429 response"""
+        with self.lock:
+            now = time.monotonic()
+            self.blocked_until = max(self.blocked_until, now + seconds)
+            self.level = float(self.capacity)
+            self.updated = now
+
+    def claim_report(self):
+        """Return whether the fill level is due to be stored, at most every few seconds"""
+        with self.lock:
+            now = time.monotonic()
+            if now - self.reported < USAGE_REPORT_INTERVAL:
+                return False
+            self.reported = now
+            return True
+
+    def usage(self):
+        """Return the current estimated budget usage"""
+        with self.lock:
+            self._leak(time.monotonic())
+            return {
+                'used': round(self.level, 1),
+                'capacity': self.capacity,
+                'ratio': self.level / self.capacity if self.capacity else 0.0,
+            }
+
+
+class CostBucket:
+    """Mirror of the GraphQL Admin API cost bucket of one shop, paced on query cost"""
+
+    def __init__(self):
+        self.maximum = GRAPHQL_MAX_COST
+        self.available = GRAPHQL_MAX_COST
+        self.restore_rate = GRAPHQL_RESTORE_RATE
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _restore(self, now):
+        self.available = min(self.maximum, self.available + (now - self.updated) * self.restore_rate)
+        self.updated = now
+
+    def acquire(self, cost):
+        """Block until ``cost`` points are available"""
+        while True:
+            with self.lock:
+                self._restore(time.monotonic())
+                cost = min(cost, self.maximum)
+                if self.available >= cost:
+                    self.available -= cost
+                    return
+                wait = (cost - self.available) / self.restore_rate
+            time.sleep(wait)
+
+    def update(self, throttle_status):
+        """Synchronise with the ``extensions.cost.throttleStatus`` of a response"""
+        if not throttle_status:
+            return
+        with self.lock:
+            self.maximum = float(throttle_status.get('maximumAvailable') or self.maximum)
+            self.available = float(throttle_status.get('currentlyAvailable', self.available))
+            self.restore_rate = float(throttle_status.get('restoreRate') or self.restore_rate)
+            self.updated = time.monotonic()
+
+
+_buckets = {}
+_cost_buckets = {}
+
+
+def get_bucket(dbname, instance_id):
+    """Return the rate limiter shared by every client of an instance in this worker"""
+    with _sessions_lock:
+        return _buckets.setdefault((dbname, instance_id), LeakyBucket())
+
+
+def get_cost_bucket(dbname, instance_id):
+    """Return the GraphQL cost limiter shared by every client of an instance in this worker"""
+    with _sessions_lock:
+        return _cost_buckets.setdefault((dbname, instance_id), CostBucket())
+
+
+def _parse_retry_after(value):
+    try:
+        return max(float(value), 0.0)
+    except (TypeError, ValueError):
+        return DEFAULT_RETRY_AFTER
+
+
+def close_sessions(instance_id=None):
+    """Close pooled sessions, for every instance or only for ``instance_id``"""
+    with _sessions_lock:
+        for key in list(_sessions):
+            if instance_id is None or key[1] == instance_id:
+                _sessions.pop(key).close()
+
+
+class ShopifyClient:
+    """Shopify Admin API client of an instance, on the pooled session of this worker"""
+
+    def __init__(self, instance):
+        self.instance_id = instance.id
+        self.registry = instance.env.registry
+        self.shop_url = instance.shop_url
+        self.timeout = instance.api_timeout or 30
+        token = instance.access_token or instance.api_secret
+        headers = {
+            'X-Shopify-Access-Token': token,
+            'Content-Type': 'application/json',
+        }
+        key = (instance.env.cr.dbname, instance.id, instance.shop_url, token)
+        # Connections are reused across models and cron runs of the worker
+        self.session = _get_session(key, instance.api_pool_size or 10, headers)
+        self.bucket = get_bucket(instance.env.cr.dbname, instance.id)
+        self.cost_bucket = get_cost_bucket(instance.env.cr.dbname, instance.id)
+
+    def url(self, path):
+        """Build an absolute Admin API URL, full URLs are returned unchanged"""
+        if path.startswith('https://'):
+            return path
+        return f"https://{self.shop_url}/admin/api/{API_VERSION}/{path.lstrip('/')}"
+
+    def request(self, method, path, **kwargs):
+        """Send a throttled request and return the raw ``requests.Response``"""
+        kwargs.setdefault('timeout', self.timeout)
+        url = self.url(path)
+        for attempt in range(MAX_THROTTLE_RETRIES + 1):
+            self.bucket.acquire()
+            self._reserve_call()
+            response = self.session.request(method, url, **kwargs)
+            call_limit = response.headers.get('X-Shopify-Shop-Api-Call-Limit')
+            if call_limit:
+                self.bucket.update(call_limit)
+            if response.status_code != 429 or attempt == MAX_THROTTLE_RETRIES:
+                if call_limit:
+                    self._report_usage()
+                return response
+            retry_after = _parse_retry_after(response.headers.get('Retry-After'))
+            _logger.info("Shopify throttled %s %s, retrying in %.1fs", method, url, retry_after)
+            self.bucket.backoff(retry_after)
+            self._report_usage(force=True)
+        return response
+
+    def _reserve_call(self):
+        """Block until the bucket shared by every worker of the instance has room for one call"""
+        while True:
+            try:
+                wait = self._take_shared_slot()
+            except psycopg2.Error as e:
+                # Fall back on the pacing of this worker only
+                _logger.debug("Could not reserve an API call of instance %s: %s", self.instance_id, e)
+                return
+            if not wait:
+                return
+            time.sleep(wait)
+
+    def _take_shared_slot(self):
+        """Take one call from the shared bucket, return the seconds to wait when it is full"""
+        # Own short transaction, so that it also works from export threads and
+        # the row lock is released as soon as the slot is taken
+        with self.registry.cursor() as cr:
+            cr.execute("""
+                INSERT INTO shopify_api_usage (instance_id, used, capacity, reported_at)
+                VALUES (%s, 0, %s, clock_timestamp() at time zone 'UTC')
+                ON CONFLICT (instance_id) DO NOTHING
+            """, [self.instance_id, self.bucket.capacity])
+            cr.execute("""
+                SELECT GREATEST(used - extract(epoch FROM (clock_timestamp() at time zone 'UTC') - reported_at)
+                                       * capacity / %s, 0), capacity
+                FROM shopify_api_usage
+                WHERE instance_id = %s
+                FOR UPDATE
+            """, [BUCKET_LEAK_DIVISOR, self.instance_id])
+            level, capacity = cr.fetchone()
+            ceiling = capacity - BUCKET_SAFETY_MARGIN
+            if level + 1 > ceiling:
+                return (level + 1 - ceiling) * BUCKET_LEAK_DIVISOR / capacity
+            cr.execute("""
+                UPDATE shopify_api_usage
+                SET used = %s, reported_at = clock_timestamp() at time zone 'UTC'
+                WHERE instance_id = %s
+            """, [level + 1, self.instance_id])
+        return 0.0
+
+    def _report_usage(self, force=False):
+        """Merge the fill level reported by Shopify into the shared bucket"""
+        if not self.bucket.claim_report() and not force:
+            return
+        usage = self.bucket.usage()
+        try:
+            with self.registry.cursor() as cr:
+                # Calls reserved by other workers may not be counted by Shopify
+                # yet, so the stored level is only ever raised to the reading
+                cr.execute("""
+                    INSERT INTO shopify_api_usage AS u (instance_id, used, capacity, reported_at)
+                    VALUES (%s, %s, %s, clock_timestamp() at time zone 'UTC')
+                    ON CONFLICT (instance_id) DO UPDATE
+                    SET used = GREATEST(EXCLUDED.used, u.used - extract(epoch FROM EXCLUDED.reported_at - u.reported_at)
+                                                              * u.capacity / %s),
+                        capacity = EXCLUDED.capacity,
+                        reported_at = EXCLUDED.reported_at
+                """, [self.instance_id, usage['used'], usage['capacity'], BUCKET_LEAK_DIVISOR])
+        except psycopg2.Error as e:
+            _logger.debug("Could not store the API usage of instance %s: %s", self.instance_id, e)
+
+    def get(self, path, params=None, **kwargs):
+        return self.request('GET', path, params=params, **kwargs)
+
+    def post(self, path, json=None, **kwargs):
+        return self.request('POST', path, json=json, **kwargs)
+
+    def put(self, path, json=None, **kwargs):
+        return self.request('PUT', path, json=json, **kwargs)
+
+    def delete(self, path, **kwargs):
+        return self.request('DELETE', path, **kwargs)
+
+    def graphql(self, query, variables=None, cost=None):
+        """Run a GraphQL Admin API query, reserving ``cost`` points beforehand, and return its ``data``"""
+        # GraphQL calls do not count against the REST call limit and carry no
+        # call limit header: only the cost bucket paces them
+        url = self.url('graphql.json')
+        for attempt in range(MAX_THROTTLE_RETRIES + 1):
+            if cost:
+                self.cost_bucket.acquire(cost)
+            response = self.session.post(url, json={'query': query, 'variables': variables or {}},
+                                         timeout=self.timeout)
+            if response.status_code == 429 and attempt < MAX_THROTTLE_RETRIES:
+                retry_after = _parse_retry_after(response.headers.get('Retry-After'))
+                _logger.info("Shopify throttled a GraphQL query, retrying in %.1fs", retry_after)
+                time.sleep(retry_after)
+                continue
+            if response.status_code != 200:
+                raise UserError(_("GraphQL request failed: %s") % response.text)
+            payload = response.json()
+            query_cost = (payload.get('extensions') or {}).get('cost') or {}
+            self.cost_bucket.update(query_cost.get('throttleStatus'))
+            throttled = any(
+                (error.get('extensions') or {}).get('code') == 'THROTTLED'
+                for error in payload.get('errors') or []
+            )
+            if throttled and attempt < MAX_THROTTLE_RETRIES:
+                cost = query_cost.get('requestedQueryCost') or cost or 1
+                _logger.info("Shopify throttled a GraphQL query costing %s points, waiting for the bucket", cost)
+                continue
+            if payload.get('errors'):
+                raise UserError(_("GraphQL request failed: %s") % payload['errors'])
+            return payload.get('data') or {}
+
+    def iter_lines(self, url):
+        """Stream a remote text document (e.g. a bulk operation result) line by line"""
+        # Bulk results are served from a signed storage URL: the download must
+        # not carry the access token and does not count against the bucket.
+        with requests.get(url, stream=True, timeout=self.timeout) as response:
+            response.raise_for_status()
+            for line in response.iter_lines():
+                if line:
+                    yield line
+
+
+def gid_to_id(gid):
+    """Return the numeric id of a GraphQL global id (``gid://shopify/Product/42``)"""
+    return gid.rsplit('/', 1)[-1] if gid else None
+
+
+def parse_datetime(value):
+    """Convert a Shopify ISO 8601 timestamp to a naive UTC datetime"""
+    if not value or isinstance(value, datetime):
+        return value or None
+    parsed = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    if parsed.tzinfo:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed
+
+
+def format_datetime(value):
+    """Format a naive UTC datetime for Shopify query parameters"""
+    return value.strftime('%Y-%m-%dT%H:%M:%S+00:00')
@@ -1,12 +1,15 @@
 from odoo import models, fields, api, _
 from odoo.exceptions import ValidationError, UserError
-import requests
 import json
+from collections import Counter
+
+from .shopify_api import parse_datetime
 
 
 class ShopifyCustomer(models.Model):
     _name = 'shopify.customer'
     _description = 'Shopify Customer'
+    _inherit = ['shopify.mapping.mixin']
     _rec_name = 'name'
 
     name = fields.Char('Customer Name', required=True)
@@ -56,23 +59,20 @@ class ShopifyCustomer(models.Model):
     def import_from_shopify(self, instance):
         """Import customers from Shopify"""
         try:
-            headers = {
-                'X-Shopify-Access-Token': instance.access_token or instance.api_secret,
-                'Content-Type': 'application/json'
-            }
-
-            url = f"https://{instance.shop_url}/admin/api/2023-10/customers.json"
+            client = instance._get_api_client()
+            url = 'customers.json'
             params = {'limit': 250}
+            stats = Counter()
 
             while url:
-                response = requests.get(url, headers=headers, params=params, timeout=30)
+                response = client.get(url, params=params)
 
                 if response.status_code == 200:
                     data = response.json()
                     customers = data.get('customers', [])
 
                     for customer_data in customers:
-                        self._create_or_update_customer(instance, customer_data)
+                        self._create_or_update_customer(instance, customer_data, stats)
 
                     # Handle pagination
                     url = self._get_next_page_url(response.headers)
@@ -84,9 +84,11 @@ class ShopifyCustomer(models.Model):
             self.env['shopify.log'].create({
                 'instance_id': instance.id,
                 'operation': 'customer_import',
-                'message': 'Customers imported successfully',
+                'message': 'Customers imported successfully: %(created)s created, '
+                           '%(updated)s updated, %(skipped)s unchanged' % stats,
                 'status': 'success'
             })
+            return stats
 
         except Exception as e:
             self.env['shopify.log'].create({
@@ -96,8 +98,10 @@ class ShopifyCustomer(models.Model):
                 'status': 'error'
             })
 
-    def _create_or_update_customer(self, instance, customer_data):
+    def _create_or_update_customer(self, instance, customer_data, stats=None):
         """Create or update customer from Shopify data"""
+        if stats is None:
+            stats = Counter()
         shopify_id = str(customer_data.get('id'))
         existing_customer = self.search([
             ('shopify_id', '=', shopify_id),
@@ -105,15 +109,23 @@ class ShopifyCustomer(models.Model):
         ], limit=1)
 
         vals = self._prepare_customer_vals(instance, customer_data)
+        payload_hash = self._shopify_payload_hash(customer_data)
 
         if existing_customer:
-            existing_customer.write(vals)
             customer = existing_customer
+            changed = customer._write_shopify_vals(vals, payload_hash)
+            stats['updated' if changed else 'skipped'] += 1
         else:
-            customer = self.create(vals)
+            customer = self._create_shopify_records([dict(vals, shopify_payload_hash=payload_hash)])
+            if not customer:
+                stats['skipped'] += 1
+                return customer
+            changed = True
+            stats['created'] += 1
 
         # Import addresses
-        self._import_customer_addresses(customer, customer_data.get('addresses', []))
+        if changed:
+            self._import_customer_addresses(customer, customer_data.get('addresses', []))
 
         # Auto-create partner if configured
         if instance.auto_import_customers and not customer.imported:
@@ -144,9 +156,9 @@ class ShopifyCustomer(models.Model):
             'accepts_marketing': customer_data.get('accepts_marketing'),
             'verified_email': customer_data.get('verified_email'),
             'tax_exempt': customer_data.get('tax_exempt'),
-            'shopify_created_at': customer_data.get('created_at'),
-            'shopify_updated_at': customer_data.get('updated_at'),
-            'last_order_date': customer_data.get('last_order_date'),
+            'shopify_created_at': parse_datetime(customer_data.get('created_at')),
+            'shopify_updated_at': parse_datetime(customer_data.get('updated_at')),
+            'last_order_date': parse_datetime(customer_data.get('last_order_date')),
             'orders_count': customer_data.get('orders_count', 0),
             'total_spent': float(customer_data.get('total_spent', 0)),
             'currency': customer_data.get('currency'),
@@ -175,10 +187,10 @@ class ShopifyCustomer(models.Model):
 
     def _import_customer_addresses(self, customer, addresses_data):
         """Import customer addresses"""
-        for address_data in addresses_data:
-            self.env['shopify.customer.address']._create_or_update_address(
-                customer, address_data
-            )
+        Address = self.env['shopify.customer.address']
+        Address._upsert_shopify_rows([
+            Address._prepare_address_vals(customer, address_data) for address_data in addresses_data
+        ])
 
     def _get_next_page_url(self, headers):
         """Extract next page URL from response headers"""
@@ -288,11 +300,6 @@ class ShopifyCustomer(models.Model):
         if not self.partner_id:
             raise UserError(_("No Odoo partner linked to this customer"))
 
-        headers = {
-            'X-Shopify-Access-Token': self.instance_id.access_token or self.instance_id.api_secret,
-            'Content-Type': 'application/json'
-        }
-
         customer_data = {
             'customer': {
                 'id': int(self.shopify_id),
@@ -304,8 +311,8 @@ class ShopifyCustomer(models.Model):
             }
         }
 
-        url = f"https://{self.instance_id.shop_url}/admin/api/2023-10/customers/{self.shopify_id}.json"
-        response = requests.put(url, headers=headers, json=customer_data, timeout=30)
+        client = self.instance_id._get_api_client()
+        response = client.put(f"customers/{self.shopify_id}.json", json=customer_data)
 
         if response.status_code == 200:
             self.last_sync = fields.Datetime.now()
@@ -326,6 +333,8 @@ class ShopifyCustomer(models.Model):
 class ShopifyCustomerAddress(models.Model):
     _name = 'shopify.customer.address'
     _description = 'Shopify Customer Address'
+    _inherit = ['shopify.mapping.mixin']
+    _shopify_scope_field = 'customer_id'
 
     name = fields.Char('Address Name')
     shopify_id = fields.Char('Shopify Address ID', required=True)
@@ -347,21 +356,15 @@ class ShopifyCustomerAddress(models.Model):
     is_default = fields.Boolean('Default Address')
 
     @api.model
-    def _create_or_update_address(self, customer, address_data):
-        """Create or update address from Shopify data"""
-        shopify_id = str(address_data.get('id'))
-        existing_address = self.search([
-            ('shopify_id', '=', shopify_id),
-            ('customer_id', '=', customer.id)
-        ], limit=1)
-
+    def _prepare_address_vals(self, customer, address_data):
+        """Prepare address values from Shopify data"""
         first_name = address_data.get('first_name', '')
         last_name = address_data.get('last_name', '')
         name = f"{first_name} {last_name}".strip() or 'Address'
 
-        vals = {
+        return {
             'name': name,
-            'shopify_id': shopify_id,
+            'shopify_id': str(address_data.get('id')),
             'customer_id': customer.id,
             'first_name': first_name,
             'last_name': last_name,
@@ -374,10 +377,4 @@ class ShopifyCustomerAddress(models.Model):
             'zip': address_data.get('zip'),
             'phone': address_data.get('phone'),
             'is_default': address_data.get('default', False)
-        }
-
-        if existing_address:
-            existing_address.write(vals)
-            return existing_address
-        else:
-            return self.create(vals)
\ No newline at end of file
+        }
\ No newline at end of file
@@ -1,11 +1,15 @@
-from odoo import models, fields, api, _
+from odoo import models, fields, api, tools, _
 from odoo.exceptions import ValidationError, UserError
-import requests
 import json
 import base64
 import hashlib
 import hmac
 
+from .shopify_api import ShopifyClient, close_sessions, BUCKET_LEAK_DIVISOR
+
+# Fields read by the webhook controller through the cached instance lookup
+WEBHOOK_CONFIG_FIELDS = {'shop_url', 'webhook_secret', 'is_active', 'webhook_coalesce_window'}
+
 
 class ShopifyInstance(models.Model):
     _name = 'shopify.instance'
@@ -19,6 +23,14 @@ class ShopifyInstance(models.Model):
     access_token = fields.Char('Access Token')
     webhook_secret = fields.Char('Webhook Secret')
 
+    # API client
+    api_pool_size = fields.Integer('API Connection Pool Size', default=10,
+                                   help="Maximum number of keep-alive connections kept open to Shopify per worker")
+    api_timeout = fields.Integer('API Timeout (seconds)', default=30)
+    api_budget_usage = fields.Float('API Budget Usage (%)', compute='_compute_api_budget_usage',
+                                    help="Estimated fill level of the Shopify API call bucket, as last reported by Shopify")
+    api_budget_reported_at = fields.Datetime('API Budget Reported At', compute='_compute_api_budget_usage')
+
     # Status
     state = fields.Selection([
         ('draft', 'Draft'),
@@ -35,13 +47,43 @@ class ShopifyInstance(models.Model):
     auto_import_products = fields.Boolean('Auto Import Products', default=False)
     auto_import_customers = fields.Boolean('Auto Import Customers', default=True)
     auto_sync_stock = fields.Boolean('Auto Sync Stock', default=True)
+    auto_export_products = fields.Boolean('Auto Export Product Changes', default=False,
+                                          help="Periodically export the linked products edited in Odoo")
+    stock_push_backend = fields.Selection([
+        ('rest', 'REST (one call per variant)'),
+        ('graphql', 'GraphQL (batched)'),
+    ], default='rest', string='Stock Push Backend', required=True,
+        help="GraphQL sends up to 250 quantities per call with inventorySetQuantities")
+    stock_push_delay = fields.Integer('Stock Push Delay (s)', default=30,
+                                      help="Stock moves are collected for this many seconds and "
+                                           "pushed to Shopify together")
+    webhook_coalesce_window = fields.Integer('Webhook Coalescing Window (s)', default=10,
+                                             help="Order and product update webhooks are held for this many "
+                                                  "seconds so that only the latest update of a burst is applied")
     auto_create_invoices = fields.Boolean('Auto Create Invoices', default=True)
+    product_import_mode = fields.Selection([
+        ('rest', 'REST (paginated)'),
+        ('bulk', 'GraphQL Bulk Operation'),
+    ], default='rest', string='Product Import Mode', required=True,
+        help="Bulk operations let Shopify export the whole catalog as one file, "
+             "which is much faster for large catalogs")
+    product_match_threshold = fields.Float('Name Match Threshold', default=0.5,
+                                           help="Minimum name similarity (0-1) for an order line without "
+                                                "SKU or variant match to be linked to an Odoo product")
 
     # Mapping
     warehouse_id = fields.Many2one('stock.warehouse', 'Default Warehouse')
     pricelist_id = fields.Many2one('product.pricelist', 'Default Pricelist')
+    manage_compare_at_price = fields.Boolean('Manage Compare-at Prices', default=False,
+                                             help="Publish the sales price as compare-at price of variants the "
+                                                  "pricelist discounts, and clear it otherwise. When unset, the "
+                                                  "compare-at prices set in Shopify are left untouched")
     payment_term_id = fields.Many2one('account.payment.term', 'Default Payment Term')
     team_id = fields.Many2one('crm.team', 'Sales Team')
+    location_ids = fields.One2many('shopify.location', 'instance_id', 'Shopify Locations')
+
+    # Incremental sync
+    sync_cursor_ids = fields.One2many('shopify.sync.cursor', 'instance_id', 'Sync Cursors')
 
     # Counts
     product_count = fields.Integer('Products', compute='_compute_counts')
@@ -55,12 +97,72 @@ class ShopifyInstance(models.Model):
             record.order_count = self.env['shopify.order'].search_count([('instance_id', '=', record.id)])
             record.customer_count = self.env['shopify.customer'].search_count([('instance_id', '=', record.id)])
 
+    def _compute_api_budget_usage(self):
+        for record in self:
+            budget = record.get_api_budget() if record.id else {}
+            record.api_budget_usage = budget.get('ratio', 0.0) * 100
+            record.api_budget_reported_at = budget.get('reported_at')
+
     @api.constrains('shop_url')
     def _check_shop_url(self):
         for record in self:
             if record.shop_url and not record.shop_url.endswith('.myshopify.com'):
                 raise ValidationError(_("Shop URL must end with '.myshopify.com'"))
 
+    @api.model_create_multi
+    def create(self, vals_list):
+        records = super().create(vals_list)
+        self.clear_caches()
+        return records
+
+    def write(self, vals):
+        res = super().write(vals)
+        if {'shop_url', 'access_token', 'api_secret', 'api_pool_size'} & set(vals):
+            for record in self:
+                close_sessions(record.id)
+        if WEBHOOK_CONFIG_FIELDS & set(vals):
+            self.clear_caches()
+        return res
+
+    def unlink(self):
+        res = super().unlink()
+        self.clear_caches()
+        return res
+
+    @api.model
+    @tools.ormcache('shop_domain')
+    def _get_webhook_config(self, shop_domain):
+        """Return ``(id, webhook secret, active, coalescing window)`` of the active instance of ``shop_domain``"""
+        # Cached per worker and cleared whenever an instance changes, so that
+        # webhook deliveries do not query the instance table
+        instance = self.sudo().search([
+            ('shop_url', '=', shop_domain),
+            ('is_active', '=', True)
+        ], limit=1)
+        if not instance:
+            return None
+        return instance.id, instance.webhook_secret, instance.is_active, instance.webhook_coalesce_window
+
+    def _get_api_client(self):
+        """Return the pooled Shopify API client of this instance"""
+        self.ensure_one()
+        return ShopifyClient(self)
+
+    def get_api_budget(self):
+        """Return the API call budget usage of this instance, leaked since the last reading"""
+        self.ensure_one()
+        usage = self.env['shopify.api.usage'].sudo().search([('instance_id', '=', self.id)], limit=1)
+        if not usage or not usage.capacity:
+            return {'used': 0.0, 'capacity': 0, 'ratio': 0.0, 'reported_at': False}
+        elapsed = (fields.Datetime.now() - usage.reported_at).total_seconds()
+        used = max(0.0, usage.used - elapsed * usage.capacity / BUCKET_LEAK_DIVISOR)
+        return {
+            'used': round(used, 1),
+            'capacity': usage.capacity,
+            'ratio': used / usage.capacity,
+            'reported_at': usage.reported_at,
+        }
+
     def create_shopify_instance(self):
         """Create a new Shopify instance"""
         if not self.shop_url or not self.api_key or not self.api_secret:
@@ -72,13 +174,7 @@ class ShopifyInstance(models.Model):
     def validate_shopify_credentials(self):
         """Validate Shopify API credentials"""
         try:
-            headers = {
-                'X-Shopify-Access-Token': self.access_token or self.api_secret,
-                'Content-Type': 'application/json'
-            }
-
-            url = f"https://{self.shop_url}/admin/api/2023-10/shop.json"
-            response = requests.get(url, headers=headers, timeout=30)
+            response = self._get_api_client().get('shop.json')
 
             if response.status_code == 200:
                 shop_data = response.json()
@@ -162,11 +258,6 @@ class ShopifyInstance(models.Model):
     def _create_webhook(self, topic, address):
         """Create individual webhook"""
         try:
-            headers = {
-                'X-Shopify-Access-Token': self.access_token or self.api_secret,
-                'Content-Type': 'application/json'
-            }
-
             base_url = self.env['ir.config_parameter'].sudo().get_param('web.base.url')
             webhook_data = {
                 'webhook': {
@@ -176,8 +267,7 @@ class ShopifyInstance(models.Model):
                 }
             }
 
-            url = f"https://{self.shop_url}/admin/api/2023-10/webhooks.json"
-            response = requests.post(url, headers=headers, json=webhook_data, timeout=30)
+            response = self._get_api_client().post('webhooks.json', json=webhook_data)
 
             if response.status_code == 201:
                 self.env['shopify.log'].create({
@@ -253,6 +343,11 @@ class ShopifyInstance(models.Model):
         # Implementation will be in shopify_product model
         self.env['shopify.product'].import_from_shopify(self)
 
+    def action_full_product_resync(self):
+        """Re-import every product, ignoring the incremental sync cursor"""
+        self.env['shopify.product'].import_from_shopify(self, full_sync=True)
+        return True
+
     def import_shopify_orders(self):
         """Import orders from Shopify"""
         # Implementation will be in shopify_order model
@@ -263,6 +358,26 @@ class ShopifyInstance(models.Model):
         # Implementation will be in shopify_customer model
         self.env['shopify.customer'].import_from_shopify(self)
 
+    def _compute_export_prices(self, products):
+        """Return the price to publish for each of ``products``, from the pricelist or the sales price"""
+        self.ensure_one()
+        if not self.pricelist_id:
+            return {product.id: product.lst_price for product in products}
+        # One pricelist evaluation for all the products
+        results = self.pricelist_id._compute_price_rule(products, 1.0)
+        return {product_id: price for product_id, (price, rule_id) in results.items()}
+
+    def action_import_locations(self):
+        """Fetch the Shopify locations to map them to Odoo warehouses"""
+        for instance in self:
+            self.env['shopify.location'].import_from_shopify(instance)
+        return True
+
+    def sync_shopify_stock(self):
+        """Push changed stock levels to Shopify"""
+        for instance in self:
+            self.env['shopify.stock.level'].sync_instance_stock(instance)
+
     @api.model
     def get_dashboard_stats(self):
         """Get dashboard statistics for all active instances"""
@@ -351,4 +466,21 @@ class ShopifyInstance(models.Model):
                 'create_date': log.create_date.isoformat() if log.create_date else None,
             })
 
-        return result
\ No newline at end of file
+        return result
+
+
+class ShopifyApiUsage(models.Model):
+    """REST call bucket of each instance, shared by every worker"""
+    _name = 'shopify.api.usage'
+    _description = 'Shopify API Usage'
+    _rec_name = 'instance_id'
+    _log_access = False
+
+    instance_id = fields.Many2one('shopify.instance', 'Shopify Instance', required=True, ondelete='cascade')
+    used = fields.Float('Used Calls')
+    capacity = fields.Integer('Bucket Capacity')
+    reported_at = fields.Datetime('Reported At')
+
+    _sql_constraints = [
+        ('instance_uniq', 'unique(instance_id)', 'There can only be one API usage per instance.'),
+    ]
@@ -0,0 +1,72 @@
+from odoo import models, fields, api, _
+from odoo.exceptions import UserError
+import logging
+
+_logger = logging.getLogger(__name__)
+
+
+class ShopifyLocation(models.Model):
+    _name = 'shopify.location'
+    _description = 'Shopify Location'
+    _inherit = ['shopify.mapping.mixin']
+    _order = 'instance_id, name'
+
+    name = fields.Char('Location Name', required=True)
+    shopify_id = fields.Char('Shopify Location ID', required=True)
+    instance_id = fields.Many2one('shopify.instance', 'Shopify Instance', required=True, ondelete='cascade')
+    active = fields.Boolean('Active', default=True)
+
+    # Odoo mapping
+    warehouse_id = fields.Many2one('stock.warehouse', 'Warehouse')
+    location_id = fields.Many2one('stock.location', 'Stock Location', domain=[('usage', '=', 'internal')],
+                                  help="Stock pushed to this Shopify location is taken from this location and "
+                                       "its children. Defaults to the stock location of the warehouse.")
+
+    # Details
+    city = fields.Char('City')
+    country_code = fields.Char('Country Code')
+    last_sync = fields.Datetime('Last Sync')
+
+    @api.onchange('warehouse_id')
+    def _onchange_warehouse_id(self):
+        if self.warehouse_id and self.location_id.warehouse_id != self.warehouse_id:
+            self.location_id = False
+
+    def _get_stock_location(self):
+        """Return the Odoo location whose stock is pushed to this Shopify location"""
+        self.ensure_one()
+        return self.location_id or self.warehouse_id.lot_stock_id
+
+    @api.model
+    def import_from_shopify(self, instance):
+        """Fetch the locations of the shop, mapping a single one to the default warehouse"""
+        response = instance._get_api_client().get('locations.json')
+        if response.status_code != 200:
+            raise UserError(_("Failed to fetch locations: %s") % response.text)
+
+        locations_data = response.json().get('locations', [])
+        existing = {
+            location.shopify_id: location
+            for location in self.with_context(active_test=False).search([('instance_id', '=', instance.id)])
+        }
+        single = len([data for data in locations_data if data.get('active')]) == 1
+
+        for data in locations_data:
+            vals = {
+                'name': data.get('name'),
+                'shopify_id': str(data.get('id')),
+                'instance_id': instance.id,
+                'active': data.get('active', True),
+                'city': data.get('city'),
+                'country_code': data.get('country_code'),
+                'last_sync': fields.Datetime.now(),
+            }
+            location = existing.get(vals['shopify_id'])
+            if location:
+                location._write_shopify_vals(vals, self._shopify_payload_hash(data))
+            else:
+                if single and vals['active']:
+                    vals['warehouse_id'] = instance.warehouse_id.id
+                self.create(dict(vals, shopify_payload_hash=self._shopify_payload_hash(data)))
+
+        return self.search([('instance_id', '=', instance.id)])
@@ -0,0 +1,139 @@
+from odoo import models, fields, api
+from odoo.tools import split_every
+import hashlib
+import json
+import logging
+
+import psycopg2
+
+_logger = logging.getLogger(__name__)
+
+# Records created from Odoo before their first export carry an empty
+# shopify_id, they are left out of the unique index.
+SHOPIFY_ID_PREDICATE = "shopify_id <> ''"
+
+UPSERT_BATCH_SIZE = 500
+
+# Bookkeeping fields that do not make a record "changed" on their own
+CHANGE_IGNORED_FIELDS = {'last_sync'}
+
+
+class ShopifyMappingMixin(models.AbstractModel):
+    """Records mirroring a Shopify object, unique on ``shopify_id`` within ``_shopify_scope_field``"""
+    _name = 'shopify.mapping.mixin'
+    _description = 'Shopify Mapping Mixin'
+
+    # The instance for top-level objects, the parent record for child objects
+    _shopify_scope_field = 'instance_id'
+
+    shopify_payload_hash = fields.Char('Shopify Payload Hash', copy=False, readonly=True,
+                                       help="Hash of the last Shopify payload applied to this record")
+
+    def init(self):
+        super().init()
+        if self._abstract or not self._auto:
+            return
+        self.env.cr.execute(f"""
+            CREATE UNIQUE INDEX IF NOT EXISTS {self._table}_shopify_id_uniq
+            ON {self._table} ({self._shopify_scope_field}, shopify_id)
+            WHERE {SHOPIFY_ID_PREDICATE}
+        """)
+
+    @api.model
+    def _shopify_payload_hash(self, data):
+        """Return a stable hash of a Shopify payload"""
+        return hashlib.sha1(json.dumps(data, sort_keys=True, default=str).encode()).hexdigest()
+
+    def _write_shopify_vals(self, vals, payload_hash):
+        """Write the values that differ unless the payload hash is unchanged, return whether it changed"""
+        self.ensure_one()
+        if payload_hash == self.shopify_payload_hash:
+            return False
+        changed = {'shopify_payload_hash': payload_hash}
+        for name, value in vals.items():
+            field = self._fields[name]
+            if name not in CHANGE_IGNORED_FIELDS and \
+                    field.convert_to_write(value, self) != field.convert_to_write(self[name], self):
+                changed[name] = value
+        if len(changed) > 1 and 'last_sync' in vals:
+            changed['last_sync'] = vals['last_sync']
+        self.write(changed)
+        return True
+
+    @api.model
+    def _create_shopify_records(self, vals_list):
+        """Create records, leaving out the ones a concurrent import created"""
+        if not vals_list:
+            return self.browse()
+        try:
+            with self.env.cr.savepoint():
+                return self.create(vals_list)
+        except psycopg2.errors.UniqueViolation:
+            pass
+
+        # The rejected records are left to the concurrent transaction, which
+        # applies the same payload: its row is not visible to this one anyway
+
+        records = self.browse()
+        for vals in vals_list:
+            try:
+                with self.env.cr.savepoint():
+                    records |= self.create(vals)
+            except psycopg2.errors.UniqueViolation:
+                _logger.info("%s %s was imported concurrently, skipped", self._name, vals['shopify_id'])
+        return records
+
+    @api.model
+    def _upsert_shopify_rows(self, vals_list):
+        """Insert or update plain stored fields, return the ``created``/``updated`` ids and ``skipped`` count"""
+        # Rows are matched on the scope field and shopify_id in the insert
+        # itself, so concurrent imports cannot create duplicates
+        scope = self._shopify_scope_field
+        # ON CONFLICT cannot touch the same row twice in one statement
+        rows = {(vals[scope], vals['shopify_id']): vals for vals in vals_list}
+        result = {'created': [], 'updated': [], 'skipped': 0}
+        if not rows:
+            return result
+
+        columns = sorted({name for vals in rows.values() for name in vals})
+        updated_columns = [name for name in columns if name not in (scope, 'shopify_id')]
+        compared_columns = [name for name in updated_columns if name not in CHANGE_IGNORED_FIELDS]
+        fields_ = [self._fields[name] for name in columns]
+        placeholder = "(%s, %%s, (now() at time zone 'UTC'), %%s, (now() at time zone 'UTC'))" % (
+            ', '.join(['%s'] * len(columns))
+        )
+
+        self.flush_model()
+        for batch in split_every(UPSERT_BATCH_SIZE, list(rows.values())):
+            params = []
+            for vals in batch:
+                params += [field.convert_to_column(vals.get(field.name), self, vals) for field in fields_]
+                params += [self.env.uid, self.env.uid]
+            self.env.cr.execute(f"""
+                INSERT INTO {self._table} AS t ({', '.join(columns)}, create_uid, create_date, write_uid, write_date)
+                VALUES {', '.join([placeholder] * len(batch))}
+                ON CONFLICT ({scope}, shopify_id) WHERE {SHOPIFY_ID_PREDICATE}
+                DO UPDATE SET {', '.join(f'{name} = EXCLUDED.{name}' for name in updated_columns + ['write_uid', 'write_date'])}
+                WHERE ({', '.join(f't.{name}' for name in compared_columns)})
+                    IS DISTINCT FROM ({', '.join(f'EXCLUDED.{name}' for name in compared_columns)})
+                RETURNING id, (xmax = 0) AS inserted
+            """, params)
+            returned = self.env.cr.fetchall()
+            for record_id, inserted in returned:
+                result['created' if inserted else 'updated'].append(record_id)
+            result['skipped'] += len(batch) - len(returned)
+
+        self._invalidate_upserted_cache(columns)
+        return result
+
+    def _invalidate_upserted_cache(self, columns):
+        """Drop cached values made stale by a raw SQL upsert"""
+        self.invalidate_model(columns + ['write_uid', 'write_date'])
+        parent = self.env[self._fields[self._shopify_scope_field].comodel_name]
+        inverse_fields = [
+            name for name, field in parent._fields.items()
+            if field.type == 'one2many' and field.comodel_name == self._name
+            and field.inverse_name == self._shopify_scope_field
+        ]
+        if inverse_fields:
+            parent.invalidate_model(inverse_fields)
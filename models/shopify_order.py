@@ -1,13 +1,33 @@
 from odoo import models, fields, api, _
 from odoo.exceptions import ValidationError, UserError
-import requests
 import json
-from datetime import datetime
+import logging
+import threading
+from collections import Counter, defaultdict
+from datetime import datetime, timedelta
+
+import psycopg2
+
+from .shopify_api import format_datetime, parse_datetime
+from .shopify_sync_cursor import advance_watermark
+
+_logger = logging.getLogger(__name__)
+
+# Re-read orders updated shortly before the previous watermark, so orders
+# committed late on Shopify's side (clock skew) are not missed
+ORDER_SYNC_OVERLAP = timedelta(minutes=5)
+
+# Product lookup maps used to resolve order lines, one per database and per
+# worker. Each entry is stored with the signature of the tables it was built
+# from and is rebuilt as soon as that signature changes.
+_product_indexes = {}
+_product_indexes_lock = threading.Lock()
 
 
 class ShopifyOrder(models.Model):
     _name = 'shopify.order'
     _description = 'Shopify Order'
+    _inherit = ['shopify.mapping.mixin']
     _rec_name = 'name'
 
     name = fields.Char('Order Number', required=True)
@@ -76,27 +96,39 @@ class ShopifyOrder(models.Model):
             record.line_count = len(record.line_ids)
 
     @api.model
-    def import_from_shopify(self, instance):
-        """Import orders from Shopify"""
+    def import_from_shopify(self, instance, full_sync=False):
+        """Import the orders updated since the previous run, or the unfulfilled ones on a full sync"""
         try:
-            headers = {
-                'X-Shopify-Access-Token': instance.access_token or instance.api_secret,
-                'Content-Type': 'application/json'
-            }
+            client = instance._get_api_client()
+            cursor = self.env['shopify.sync.cursor']._get_cursor(instance, 'orders')
+
+            params = {'status': 'any'}
+            if cursor.last_updated_at and not full_sync:
+                params['updated_at_min'] = format_datetime(cursor.last_updated_at - ORDER_SYNC_OVERLAP)
+            else:
+                # 'unfulfilled' covers both unshipped and partially fulfilled orders
+                params['fulfillment_status'] = 'unfulfilled'
 
-            # Import unfulfilled orders
-            self._import_orders_by_status(instance, headers, 'unfulfilled')
+            # Check the product lookup maps once, every line of the batch then
+            # trusts them without querying the signature again
+            self.env['shopify.order.line']._get_product_index()
+            self = self.with_context(shopify_product_index_checked=True)
 
-            # Import partially fulfilled orders
-            self._import_orders_by_status(instance, headers, 'partial')
+            started_at = fields.Datetime.now()
+            stats = Counter()
+            watermark = self._import_orders(instance, client, params, stats)
+            # Without any order the run still covers everything up to its start
+            cursor._advance(watermark or (started_at - ORDER_SYNC_OVERLAP, 0))
 
             instance.last_sync = fields.Datetime.now()
             self.env['shopify.log'].create({
                 'instance_id': instance.id,
                 'operation': 'order_import',
-                'message': 'Orders imported successfully',
+                'message': 'Orders imported successfully: %(created)s created, '
+                           '%(updated)s updated, %(skipped)s unchanged' % stats,
                 'status': 'success'
             })
+            return stats
 
         except Exception as e:
             self.env['shopify.log'].create({
@@ -106,24 +138,22 @@ class ShopifyOrder(models.Model):
                 'status': 'error'
             })
 
-    def _import_orders_by_status(self, instance, headers, status):
-        """Import orders by fulfillment status"""
-        url = f"https://{instance.shop_url}/admin/api/2023-10/orders.json"
-        params = {
-            'limit': 250,
-            'fulfillment_status': status,
-            'status': 'any'
-        }
+    def _import_orders(self, instance, client, params, stats=None):
+        """Import every page of orders matching ``params``"""
+        url = 'orders.json'
+        params = dict(params, limit=250)
+        watermark = None
 
         while url:
-            response = requests.get(url, headers=headers, params=params, timeout=30)
+            response = client.get(url, params=params)
 
             if response.status_code == 200:
                 data = response.json()
                 orders = data.get('orders', [])
 
                 for order_data in orders:
-                    self._create_or_update_order(instance, order_data)
+                    self._create_or_update_order(instance, order_data, stats)
+                    watermark = advance_watermark(watermark, order_data)
 
                 # Handle pagination
                 url = self._get_next_page_url(response.headers)
@@ -131,8 +161,12 @@ class ShopifyOrder(models.Model):
             else:
                 raise UserError(_("Failed to fetch orders: %s") % response.text)
 
-    def _create_or_update_order(self, instance, order_data):
+        return watermark
+
+    def _create_or_update_order(self, instance, order_data, stats=None):
         """Create or update order from Shopify data"""
+        if stats is None:
+            stats = Counter()
         shopify_id = str(order_data.get('id'))
         existing_order = self.search([
             ('shopify_id', '=', shopify_id),
@@ -140,22 +174,36 @@ class ShopifyOrder(models.Model):
         ], limit=1)
 
         vals = self._prepare_order_vals(instance, order_data)
+        payload_hash = self._shopify_payload_hash(order_data)
 
         if existing_order:
-            existing_order.write(vals)
             order = existing_order
+            changed = order._write_shopify_vals(vals, payload_hash)
+            stats['updated' if changed else 'skipped'] += 1
         else:
-            order = self.create(vals)
+            order = self._create_shopify_records([dict(vals, shopify_payload_hash=payload_hash)])
+            if not order:
+                stats['skipped'] += 1
+                return order
+            changed = True
+            stats['created'] += 1
 
         # Import order lines
-        self._import_order_lines(order, order_data.get('line_items', []))
+        if changed:
+            self._import_order_lines(order, order_data.get('line_items', []))
 
-        # Auto-process if configured
-        if instance.auto_import_orders and not order.imported:
+        # Auto-process if configured, incremental runs also return orders
+        # that were closed since and must not become new sale orders
+        if instance.auto_import_orders and not order.imported and order._is_open():
             order.create_sale_order()
 
         return order
 
+    def _is_open(self):
+        """Return whether the order still has to be fulfilled"""
+        self.ensure_one()
+        return self.fulfillment_status in (False, 'unfulfilled', 'partial') and not self.cancelled_at
+
     def _prepare_order_vals(self, instance, order_data):
         """Prepare order values from Shopify data"""
         billing_address = order_data.get('billing_address', {})
@@ -177,11 +225,11 @@ class ShopifyOrder(models.Model):
             'currency': order_data.get('currency'),
             'financial_status': order_data.get('financial_status'),
             'fulfillment_status': order_data.get('fulfillment_status'),
-            'shopify_created_at': order_data.get('created_at'),
-            'shopify_updated_at': order_data.get('updated_at'),
-            'processed_at': order_data.get('processed_at'),
-            'cancelled_at': order_data.get('cancelled_at'),
-            'closed_at': order_data.get('closed_at'),
+            'shopify_created_at': parse_datetime(order_data.get('created_at')),
+            'shopify_updated_at': parse_datetime(order_data.get('updated_at')),
+            'processed_at': parse_datetime(order_data.get('processed_at')),
+            'cancelled_at': parse_datetime(order_data.get('cancelled_at')),
+            'closed_at': parse_datetime(order_data.get('closed_at')),
             'billing_address': self._format_address(billing_address),
             'shipping_address': self._format_address(shipping_address),
             'last_sync': fields.Datetime.now()
@@ -208,10 +256,15 @@ class ShopifyOrder(models.Model):
 
     def _import_order_lines(self, order, line_items):
         """Import order line items"""
+        OrderLine = self.env['shopify.order.line']
+        variants = OrderLine._get_product_index()['variants']
+        vals_list = []
         for line_data in line_items:
-            self.env['shopify.order.line']._create_or_update_line(
-                order, line_data
-            )
+            vals = OrderLine._prepare_line_vals(order, line_data)
+            variant = variants.get((order.instance_id.id, vals['shopify_variant_id']))
+            vals['variant_id'] = variant[0] if variant else False
+            vals_list.append(vals)
+        OrderLine._upsert_shopify_rows(vals_list)
 
     def _get_next_page_url(self, headers):
         """Extract next page URL from response headers"""
@@ -244,8 +297,16 @@ class ShopifyOrder(models.Model):
         sale_order = self.env['sale.order'].create(vals)
 
         # Create order lines
+        matches = self.line_ids._match_products()
+        # Lines of the same unknown item share one generic product
+        generic_products = {}
         for line in self.line_ids:
-            line.create_sale_order_line(sale_order)
+            if not matches[line.id][0] and not line.sale_line_id:
+                key = line.sku or line.name
+                if key not in generic_products:
+                    generic_products[key] = line._create_generic_product()
+                matches[line.id] = (generic_products[key], 'generic', 0.0)
+            line.create_sale_order_line(sale_order, matches[line.id])
 
         self.sale_order_id = sale_order.id
         self.imported = True
@@ -293,11 +354,6 @@ class ShopifyOrder(models.Model):
 
     def update_order_status(self, status):
         """Update order status in Shopify"""
-        headers = {
-            'X-Shopify-Access-Token': self.instance_id.access_token or self.instance_id.api_secret,
-            'Content-Type': 'application/json'
-        }
-
         order_data = {
             'order': {
                 'id': int(self.shopify_id),
@@ -305,8 +361,8 @@ class ShopifyOrder(models.Model):
             }
         }
 
-        url = f"https://{self.instance_id.shop_url}/admin/api/2023-10/orders/{self.shopify_id}.json"
-        response = requests.put(url, headers=headers, json=order_data, timeout=30)
+        client = self.instance_id._get_api_client()
+        response = client.put(f"orders/{self.shopify_id}.json", json=order_data)
 
         if response.status_code == 200:
             self.fulfillment_status = status
@@ -319,13 +375,8 @@ class ShopifyOrder(models.Model):
 
     def cancel_shopify_order(self):
         """Cancel order in Shopify"""
-        headers = {
-            'X-Shopify-Access-Token': self.instance_id.access_token or self.instance_id.api_secret,
-            'Content-Type': 'application/json'
-        }
-
-        url = f"https://{self.instance_id.shop_url}/admin/api/2023-10/orders/{self.shopify_id}/cancel.json"
-        response = requests.post(url, headers=headers, timeout=30)
+        client = self.instance_id._get_api_client()
+        response = client.post(f"orders/{self.shopify_id}/cancel.json")
 
         if response.status_code == 200:
             self.cancelled_at = fields.Datetime.now()
@@ -336,11 +387,14 @@ class ShopifyOrder(models.Model):
 class ShopifyOrderLine(models.Model):
     _name = 'shopify.order.line'
     _description = 'Shopify Order Line'
+    _inherit = ['shopify.mapping.mixin']
+    _shopify_scope_field = 'order_id'
 
     name = fields.Char('Product Name', required=True)
     shopify_id = fields.Char('Shopify Line ID', required=True)
     order_id = fields.Many2one('shopify.order', 'Shopify Order', required=True)
     variant_id = fields.Many2one('shopify.product.variant', 'Product Variant')
+    shopify_variant_id = fields.Char('Shopify Variant ID')
     sale_line_id = fields.Many2one('sale.order.line', 'Sale Order Line')
 
     # Product details
@@ -359,19 +413,39 @@ class ShopifyOrderLine(models.Model):
     taxable = fields.Boolean('Taxable')
     fulfillment_status = fields.Char('Fulfillment Status')
 
-    @api.model
-    def _create_or_update_line(self, order, line_data):
-        """Create or update line from Shopify data"""
-        shopify_id = str(line_data.get('id'))
-        existing_line = self.search([
-            ('shopify_id', '=', shopify_id),
-            ('order_id', '=', order.id)
-        ], limit=1)
+    # Product matching
+    match_method = fields.Selection([
+        ('variant', 'Shopify Variant'),
+        ('sku', 'SKU'),
+        ('barcode', 'Barcode'),
+        ('name', 'Name Similarity'),
+        ('generic', 'Generic Product'),
+    ], string='Product Match', readonly=True)
+    match_confidence = fields.Float('Match Confidence', readonly=True,
+                                    help="Name similarity of the matched product, 1 for exact matches")
+
+    def init(self):
+        super().init()
+        try:
+            with self.env.cr.savepoint():
+                self.env.cr.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+        except psycopg2.Error:
+            _logger.warning("pg_trgm is not available, order lines will be matched "
+                            "on product names with ilike")
+            return
+        self.env.cr.execute("""
+            CREATE INDEX IF NOT EXISTS product_template_name_trgm_idx
+            ON product_template USING gin ((name->>'en_US') gin_trgm_ops)
+        """)
 
+    @api.model
+    def _prepare_line_vals(self, order, line_data):
+        """Prepare line values from Shopify data"""
         vals = {
             'name': line_data.get('title'),
-            'shopify_id': shopify_id,
+            'shopify_id': str(line_data.get('id')),
             'order_id': order.id,
+            'shopify_variant_id': str(line_data['variant_id']) if line_data.get('variant_id') else False,
             'variant_title': line_data.get('variant_title'),
             'sku': line_data.get('sku'),
             'vendor': line_data.get('vendor'),
@@ -384,23 +458,19 @@ class ShopifyOrderLine(models.Model):
         }
 
         vals['total_price'] = vals['quantity'] * vals['price'] - vals['total_discount']
+        return vals
 
-        if existing_line:
-            existing_line.write(vals)
-            return existing_line
-        else:
-            return self.create(vals)
-
-    def create_sale_order_line(self, sale_order):
+    def create_sale_order_line(self, sale_order, match=None):
         """Create sale order line in Odoo"""
         if self.sale_line_id:
             return self.sale_line_id
 
         # Find product
-        product = self._find_product()
+        product, method, confidence = match or self._match_products()[self.id]
         if not product:
             # Create a generic product or raise error
             product = self._create_generic_product()
+            method, confidence = 'generic', 0.0
 
         vals = {
             'order_id': sale_order.id,
@@ -411,23 +481,155 @@ class ShopifyOrderLine(models.Model):
         }
 
         sale_line = self.env['sale.order.line'].create(vals)
-        self.sale_line_id = sale_line.id
+        self.write({
+            'sale_line_id': sale_line.id,
+            'match_method': method,
+            'match_confidence': confidence,
+        })
 
         return sale_line
 
     def _find_product(self):
         """Find corresponding Odoo product"""
-        if self.variant_id and self.variant_id.odoo_variant_id:
-            return self.variant_id.odoo_variant_id
+        return self._match_products()[self.id][0]
+
+    def _match_products(self, index=None):
+        """Return a dict mapping line ids to ``(product, match method, confidence)``"""
+        if index is None:
+            index = self._get_product_index()
+        Product = self.env['product.product']
+        matches = {}
+        missed = self.browse()
+
+        for line in self:
+            variant = index['variants'].get((line.order_id.instance_id.id, line.shopify_variant_id))
+            if variant and variant[1]:
+                matches[line.id] = (Product.browse(variant[1]), 'variant', 1.0)
+            elif line.sku and line.sku in index['skus']:
+                matches[line.id] = (Product.browse(index['skus'][line.sku]), 'sku', 1.0)
+            elif variant and variant[2] in index['barcodes']:
+                matches[line.id] = (Product.browse(index['barcodes'][variant[2]]), 'barcode', 1.0)
+            else:
+                missed |= line
+
+        # Products created after the maps were built, e.g. generic products
+        # of earlier orders of the same batch
+        skus = {}
+        missed_skus = list(set(missed.filtered('sku').mapped('sku')))
+        if missed_skus:
+            for row in Product.search_read([('default_code', 'in', missed_skus)], ['default_code'], order='id'):
+                skus.setdefault(row['default_code'], row['id'])
+
+        # The remaining lines are matched on their name, with one similarity
+        # query per threshold
+        unmatched = defaultdict(set)
+        for line in missed:
+            if line.sku in skus:
+                matches[line.id] = (Product.browse(skus[line.sku]), 'sku', 1.0)
+            else:
+                unmatched[line.order_id.instance_id.product_match_threshold].add(line.name)
+
+        by_name = {}
+        for threshold, names in unmatched.items():
+            by_name[threshold] = self._match_product_names(names, threshold, index['trigram'])
+        for line in self:
+            if line.id not in matches:
+                threshold = line.order_id.instance_id.product_match_threshold
+                product_id, score = by_name[threshold].get(line.name, (False, 0.0))
+                matches[line.id] = (Product.browse(product_id), product_id and 'name', score)
+        return matches
 
-        if self.sku:
-            product = self.env['product.product'].search([('default_code', '=', self.sku)], limit=1)
-            if product:
-                return product
+    @api.model
+    def _match_product_names(self, names, threshold, trigram=True):
+        """Return a dict mapping names to the ``(product id, similarity)`` above ``threshold``"""
+        names = [name for name in names if name]
+        if not names:
+            return {}
+        if not trigram:
+            result = {}
+            for name in names:
+                product = self.env['product.product'].search([('name', 'ilike', name)], limit=1)
+                if product:
+                    result[name] = (product.id, 0.0)
+            return result
+
+        self.env['product.product'].flush_model(['active', 'product_tmpl_id'])
+        self.env['product.template'].flush_model(['name', 'active'])
+        # The % operator uses the trigram index, it filters on this threshold
+        self.env.cr.execute("SELECT set_config('pg_trgm.similarity_threshold', %s, true)", [str(threshold)])
+        self.env.cr.execute("""
+            SELECT DISTINCT ON (q.name) q.name, p.id, similarity(t.name->>'en_US', q.name) AS score
+            FROM unnest(%s::text[]) AS q(name)
+            JOIN product_template t ON (t.name->>'en_US') %% q.name AND t.active
+            JOIN product_product p ON p.product_tmpl_id = t.id AND p.active
+            ORDER BY q.name, score DESC, p.id
+        """, [names])
+        return {name: (product_id, score) for name, product_id, score in self.env.cr.fetchall()}
+
+    @api.model
+    def _get_product_index(self):
+        """Return the product lookup maps of this database, rebuilt when they are stale"""
+        # The maps hold the variants by (instance id, Shopify variant id), the
+        # active products by SKU and barcode, and whether pg_trgm is installed
+        dbname = self.env.cr.dbname
+        cached = _product_indexes.get(dbname)
+        # Within an import batch the maps were checked once for all orders
+        if cached and self.env.context.get('shopify_product_index_checked'):
+            return cached[1]
+
+        # Shared by every request of the worker, checked with one aggregate query
+        signature = self._product_index_signature()
+        if cached and cached[0] == signature:
+            return cached[1]
+
+        index = self._build_product_index()
+        with _product_indexes_lock:
+            _product_indexes[dbname] = (signature, index)
+        return index
 
-        # Try by name
-        product = self.env['product.product'].search([('name', 'ilike', self.name)], limit=1)
-        return product
+    @api.model
+    def _product_index_signature(self):
+        """Return a value that changes whenever the product lookup maps are stale"""
+        self.env['product.product'].flush_model(['default_code', 'barcode', 'active'])
+        self.env['shopify.product.variant'].flush_model(['shopify_id', 'odoo_variant_id', 'barcode', 'product_id'])
+        self.env.cr.execute("""
+            SELECT (SELECT count(*) FROM product_product),
+                   (SELECT max(write_date) FROM product_product),
+                   (SELECT count(*) FROM shopify_product_variant),
+                   (SELECT max(write_date) FROM shopify_product_variant)
+        """)
+        return self.env.cr.fetchone()
+
+    @api.model
+    def _build_product_index(self):
+        """Load the product lookup maps"""
+        index = {'variants': {}, 'skus': {}, 'barcodes': {}}
+
+        self.env.cr.execute("SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'")
+        index['trigram'] = bool(self.env.cr.fetchone())
+
+        # Lowest id first so duplicated codes resolve like a search(limit=1)
+        self.env.cr.execute("""
+            SELECT id, default_code, barcode
+            FROM product_product
+            WHERE active AND (default_code IS NOT NULL OR barcode IS NOT NULL)
+            ORDER BY id
+        """)
+        for product_id, default_code, barcode in self.env.cr.fetchall():
+            if default_code:
+                index['skus'].setdefault(default_code, product_id)
+            if barcode:
+                index['barcodes'].setdefault(barcode, product_id)
+
+        self.env.cr.execute("""
+            SELECT sp.instance_id, v.shopify_id, v.id, v.odoo_variant_id, v.barcode
+            FROM shopify_product_variant v
+            JOIN shopify_product sp ON sp.id = v.product_id
+            WHERE v.shopify_id <> ''
+        """)
+        for instance_id, shopify_id, variant_id, product_id, barcode in self.env.cr.fetchall():
+            index['variants'][(instance_id, shopify_id)] = (variant_id, product_id, barcode)
+        return index
 
     def _create_generic_product(self):
         """Create a generic product for unmapped items"""
@@ -1,12 +1,124 @@
 from odoo import models, fields, api, _
 from odoo.exceptions import ValidationError, UserError
-import requests
 import json
+import logging
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from odoo.tools import float_compare, split_every
+
+from .shopify_api import format_datetime, gid_to_id, parse_datetime
+from .shopify_sync_cursor import advance_watermark
+
+_logger = logging.getLogger(__name__)
+
+BULK_POLL_INTERVAL = 5
+# Products exported per instance and per run of the changed products cron
+DIRTY_EXPORT_BATCH_SIZE = 200
+# Products prepared and written back together by export_to_shopify
+EXPORT_CHUNK_SIZE = 100
+# Upper bound of concurrent export requests, also capped by the API pool size
+EXPORT_MAX_WORKERS = 8
+# Number of bulk operation products upserted together, like a REST page
+BULK_PAGE_SIZE = 250
+BULK_POLL_TIMEOUT = 3600
+
+BULK_PRODUCTS_QUERY = """
+{
+  products%(filter)s {
+    edges {
+      node {
+        id
+        title
+        handle
+        descriptionHtml
+        vendor
+        productType
+        tags
+        status
+        createdAt
+        updatedAt
+        publishedAt
+        variants {
+          edges {
+            node {
+              id
+              title
+              price
+              compareAtPrice
+              sku
+              barcode
+              inventoryQuantity
+              inventoryPolicy
+              taxable
+              selectedOptions { value }
+              inventoryItem { id }
+            }
+          }
+        }
+        images {
+          edges {
+            node { id altText width height url }
+          }
+        }
+      }
+    }
+  }
+}
+"""
+
+BULK_RUN_MUTATION = """
+mutation bulkOperationRunQuery($query: String!) {
+  bulkOperationRunQuery(query: $query) {
+    bulkOperation { id status }
+    userErrors { field message }
+  }
+}
+"""
+
+BULK_STATUS_QUERY = """
+{
+  currentBulkOperation {
+    id
+    status
+    errorCode
+    objectCount
+    url
+  }
+}
+"""
+
+PRICE_UPDATE_MUTATION = """
+mutation productVariantsBulkUpdate($productId: ID!, $variants: [ProductVariantsBulkInput!]!) {
+  productVariantsBulkUpdate(productId: $productId, variants: $variants) {
+    userErrors { field message }
+  }
+}
+"""
+# Points reserved in the GraphQL cost bucket per productVariantsBulkUpdate call
+PRICE_UPDATE_COST = 10
+
+
+def _send_product(client, shopify_id, payload):
+    """Create or update one product from an export thread, return ``(shopify_id, error)``"""
+    try:
+        if shopify_id:
+            response = client.put(f"products/{shopify_id}.json", json=payload)
+        else:
+            response = client.post('products.json', json=payload)
+    except Exception as e:
+        return None, str(e)
+    if response.status_code in [200, 201]:
+        return str(response.json()['product']['id']), None
+    return None, response.text
 
 
 class ShopifyProduct(models.Model):
     _name = 'shopify.product'
     _description = 'Shopify Product'
+    _inherit = ['shopify.mapping.mixin']
     _rec_name = 'name'
 
     name = fields.Char('Product Name', required=True)
@@ -35,7 +147,11 @@ class ShopifyProduct(models.Model):
 
     # Sync
     last_sync = fields.Datetime('Last Sync')
-    sync_required = fields.Boolean('Sync Required', default=False)
+    sync_required = fields.Boolean('Sync Required', default=False, index=True,
+                                   help="Set when the linked Odoo product changed since the last export")
+    price_sync_required = fields.Boolean('Price Sync Required', default=False, index=True,
+                                         help="Set when the price of the linked Odoo product changed since "
+                                              "the last price sync or export")
 
     # Variants
     variant_ids = fields.One2many('shopify.product.variant', 'product_id', 'Variants')
@@ -56,40 +172,28 @@ class ShopifyProduct(models.Model):
             record.image_count = len(record.image_ids)
 
     @api.model
-    def import_from_shopify(self, instance):
-        """Import products from Shopify"""
+    def import_from_shopify(self, instance, full_sync=False):
+        """Import the products updated since the previous run, or all of them on a full sync"""
         try:
-            headers = {
-                'X-Shopify-Access-Token': instance.access_token or instance.api_secret,
-                'Content-Type': 'application/json'
-            }
-
-            url = f"https://{instance.shop_url}/admin/api/2023-10/products.json"
-            params = {'limit': 250}
-
-            while url:
-                response = requests.get(url, headers=headers, params=params, timeout=30)
-
-                if response.status_code == 200:
-                    data = response.json()
-                    products = data.get('products', [])
-
-                    for product_data in products:
-                        self._create_or_update_product(instance, product_data)
+            cursor = self.env['shopify.sync.cursor']._get_cursor(instance, 'products')
+            updated_at_min = not full_sync and cursor.last_updated_at or None
+            stats = Counter()
 
-                    # Handle pagination
-                    url = self._get_next_page_url(response.headers)
-                    params = None
-                else:
-                    raise UserError(_("Failed to fetch products: %s") % response.text)
+            if instance.product_import_mode == 'bulk':
+                watermark = self._import_products_bulk(instance, updated_at_min, stats)
+            else:
+                watermark = self._import_products_rest(instance, updated_at_min, stats)
 
+            cursor._advance(watermark)
             instance.last_sync = fields.Datetime.now()
             self.env['shopify.log'].create({
                 'instance_id': instance.id,
                 'operation': 'product_import',
-                'message': 'Products imported successfully',
+                'message': 'Products imported successfully: %(created)s created, '
+                           '%(updated)s updated, %(skipped)s unchanged' % stats,
                 'status': 'success'
             })
+            return stats
 
         except Exception as e:
             self.env['shopify.log'].create({
@@ -99,29 +203,225 @@ class ShopifyProduct(models.Model):
                 'status': 'error'
             })
 
-    def _create_or_update_product(self, instance, product_data):
-        """Create or update product from Shopify data"""
-        shopify_id = str(product_data.get('id'))
-        existing_product = self.search([
-            ('shopify_id', '=', shopify_id),
-            ('instance_id', '=', instance.id)
-        ], limit=1)
+    def _import_products_rest(self, instance, updated_at_min=None, stats=None):
+        """Import products page by page through the REST API"""
+        client = instance._get_api_client()
+        url = 'products.json'
+        params = {'limit': 250}
+        if updated_at_min:
+            params['updated_at_min'] = format_datetime(updated_at_min)
+        watermark = None
+
+        while url:
+            response = client.get(url, params=params)
+
+            if response.status_code == 200:
+                data = response.json()
+                products = data.get('products', [])
+
+                self._import_product_page(instance, products, stats)
+                for product_data in products:
+                    watermark = advance_watermark(watermark, product_data)
+
+                # Handle pagination
+                url = self._get_next_page_url(response.headers)
+                params = None
+            else:
+                raise UserError(_("Failed to fetch products: %s") % response.text)
+
+        return watermark
+
+    def _import_products_bulk(self, instance, updated_at_min=None, stats=None):
+        """Import the catalog through a GraphQL bulk operation"""
+        client = instance._get_api_client()
+
+        query_filter = ''
+        if updated_at_min:
+            query_filter = '(query: "updated_at:>=\'%s\'")' % format_datetime(updated_at_min)
+        query = BULK_PRODUCTS_QUERY % {'filter': query_filter}
+
+        result = client.graphql(BULK_RUN_MUTATION, {'query': query})['bulkOperationRunQuery']
+        if result['userErrors']:
+            raise UserError(_("Failed to start bulk operation: %s") % result['userErrors'])
+
+        operation = self._wait_bulk_operation(client)
+        if operation['status'] != 'COMPLETED':
+            raise UserError(_("Bulk operation %s: %s") % (operation['status'], operation.get('errorCode')))
+
+        # An operation without any object has no result file
+        if not operation.get('url'):
+            return None
+        return self._import_bulk_jsonl(instance, client.iter_lines(operation['url']), stats)
+
+    def _wait_bulk_operation(self, client):
+        """Poll the current bulk operation until it is finished"""
+        deadline = time.monotonic() + BULK_POLL_TIMEOUT
+        while True:
+            operation = client.graphql(BULK_STATUS_QUERY)['currentBulkOperation']
+            if operation['status'] not in ('CREATED', 'RUNNING'):
+                return operation
+            if time.monotonic() > deadline:
+                raise UserError(_("Bulk operation %s did not finish in time") % operation['id'])
+            time.sleep(BULK_POLL_INTERVAL)
 
-        vals = self._prepare_product_vals(instance, product_data)
+    @api.model
+    def _import_bulk_jsonl(self, instance, lines, stats=None):
+        """Import products from the JSONL result of a bulk operation"""
+        watermark = None
+        page = []
+        for product_data in self._iter_bulk_products(lines):
+            page.append(product_data)
+            watermark = advance_watermark(watermark, product_data)
+            if len(page) >= BULK_PAGE_SIZE:
+                self._import_product_page(instance, page, stats)
+                page = []
+        self._import_product_page(instance, page, stats)
+        return watermark
+
+    def _iter_bulk_products(self, lines):
+        """Reassemble and yield the products of bulk operation JSONL lines one at a time"""
+        # Shopify writes each product before its variants and images, so a
+        # product is complete when the next one starts
+        current = None
+        for line in lines:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            parent_gid = record.get('__parentId')
+            if not parent_gid:
+                if current:
+                    yield current
+                current = self._bulk_product_data(record)
+            elif not current or parent_gid != current['admin_graphql_api_id']:
+                # Raise rather than skip, so the sync cursor is not advanced
+                # past products that could not be reassembled
+                raise UserError(_("Bulk record %s belongs to %s, which is not the current product")
+                                % (record.get('id'), parent_gid))
+            elif '/ProductVariant/' in record['id']:
+                current['variants'].append(self._bulk_variant_data(record))
+            elif '/ProductImage/' in record['id']:
+                image_data = self._bulk_image_data(record)
+                image_data['position'] = len(current['images']) + 1
+                current['images'].append(image_data)
+        if current:
+            yield current
+
+    def _bulk_product_data(self, node):
+        """Convert a bulk product node to the REST product payload shape"""
+        return {
+            'id': gid_to_id(node['id']),
+            'admin_graphql_api_id': node['id'],
+            'title': node.get('title'),
+            'handle': node.get('handle'),
+            'body_html': node.get('descriptionHtml'),
+            'vendor': node.get('vendor'),
+            'product_type': node.get('productType'),
+            'tags': ', '.join(node.get('tags') or []),
+            'status': (node.get('status') or 'active').lower(),
+            'created_at': node.get('createdAt'),
+            'updated_at': node.get('updatedAt'),
+            'published_at': node.get('publishedAt'),
+            'variants': [],
+            'images': [],
+        }
 
-        if existing_product:
-            existing_product.write(vals)
-            product = existing_product
-        else:
-            product = self.create(vals)
+    def _bulk_variant_data(self, node):
+        """Convert a bulk variant node to the REST variant payload shape"""
+        options = [option.get('value') for option in node.get('selectedOptions') or []]
+        options += [None] * (3 - len(options))
+        return {
+            'id': gid_to_id(node['id']),
+            'title': node.get('title'),
+            'price': node.get('price') or 0,
+            'compare_at_price': node.get('compareAtPrice'),
+            'sku': node.get('sku'),
+            'barcode': node.get('barcode'),
+            'inventory_quantity': node.get('inventoryQuantity') or 0,
+            'inventory_policy': (node.get('inventoryPolicy') or '').lower() or None,
+            'taxable': node.get('taxable'),
+            'option1': options[0],
+            'option2': options[1],
+            'option3': options[2],
+            'inventory_item_id': gid_to_id((node.get('inventoryItem') or {}).get('id')),
+        }
 
-        # Import variants
-        self._import_product_variants(product, product_data.get('variants', []))
+    def _bulk_image_data(self, node):
+        """Convert a bulk image node to the REST image payload shape"""
+        return {
+            'id': gid_to_id(node['id']),
+            'alt': node.get('altText'),
+            'width': node.get('width'),
+            'height': node.get('height'),
+            'src': node.get('url'),
+        }
 
-        # Import images
-        self._import_product_images(product, product_data.get('images', []))
+    def _create_or_update_product(self, instance, product_data):
+        """Create or update product from Shopify data"""
+        return self._import_product_page(instance, [product_data])
 
-        return product
+    @api.model
+    def _import_product_page(self, instance, products_data, stats=None):
+        """Create or update a page of products with their variants and images, counted in ``stats``"""
+        if stats is None:
+            stats = Counter()
+        # The last payload wins if a product appears twice in the page
+        page = {str(product_data.get('id')): product_data for product_data in products_data}
+        if not page:
+            return self.browse()
+
+        existing = {
+            product.shopify_id: product
+            for product in self.search([
+                ('shopify_id', 'in', list(page)),
+                ('instance_id', '=', instance.id)
+            ])
+        }
+
+        products = {}
+        changed = []
+        vals_to_create = []
+        for shopify_id, product_data in page.items():
+            vals = self._prepare_product_vals(instance, product_data)
+            payload_hash = self._shopify_payload_hash(product_data)
+            if shopify_id in existing:
+                product = products[shopify_id] = existing[shopify_id]
+                if product._write_shopify_vals(vals, payload_hash):
+                    changed.append(shopify_id)
+                    stats['updated'] += 1
+                else:
+                    stats['skipped'] += 1
+            else:
+                vals_to_create.append(dict(vals, shopify_payload_hash=payload_hash))
+                changed.append(shopify_id)
+        created = self._create_shopify_records(vals_to_create)
+        for product in created:
+            products[product.shopify_id] = product
+        stats['created'] += len(created)
+        # Products created meanwhile by a concurrent import are left to it
+        stats['skipped'] += len(vals_to_create) - len(created)
+        changed = [shopify_id for shopify_id in changed if shopify_id in products]
+
+        # Children of unchanged products are unchanged too; the others are
+        # upserted with one statement per model
+        Variant = self.env['shopify.product.variant']
+        Image = self.env['shopify.product.image']
+        variant_vals = []
+        image_vals = []
+        for shopify_id in changed:
+            product_data = page[shopify_id]
+            product = products[shopify_id]
+            variant_vals += [
+                Variant._prepare_variant_vals(product, variant_data)
+                for variant_data in product_data.get('variants') or []
+            ]
+            image_vals += [
+                Image._prepare_image_vals(product, image_data)
+                for image_data in product_data.get('images') or []
+            ]
+        Variant._upsert_shopify_rows(variant_vals)
+        Image._upsert_shopify_rows(image_vals)
+
+        return self.browse([products[shopify_id].id for shopify_id in page if shopify_id in products])
 
     def _prepare_product_vals(self, instance, product_data):
         """Prepare product values from Shopify data"""
@@ -135,27 +435,13 @@ class ShopifyProduct(models.Model):
             'product_type': product_data.get('product_type'),
             'tags': product_data.get('tags'),
             'status': product_data.get('status'),
-            'shopify_created_at': product_data.get('created_at'),
-            'shopify_updated_at': product_data.get('updated_at'),
-            'published_at': product_data.get('published_at'),
+            'shopify_created_at': parse_datetime(product_data.get('created_at')),
+            'shopify_updated_at': parse_datetime(product_data.get('updated_at')),
+            'published_at': parse_datetime(product_data.get('published_at')),
             'published_scope': product_data.get('published_scope'),
             'last_sync': fields.Datetime.now()
         }
 
-    def _import_product_variants(self, product, variants_data):
-        """Import product variants"""
-        for variant_data in variants_data:
-            self.env['shopify.product.variant']._create_or_update_variant(
-                product, variant_data
-            )
-
-    def _import_product_images(self, product, images_data):
-        """Import product images"""
-        for image_data in images_data:
-            self.env['shopify.product.image']._create_or_update_image(
-                product, image_data
-            )
-
     def _get_next_page_url(self, headers):
         """Extract next page URL from response headers"""
         link_header = headers.get('Link', '')
@@ -167,46 +453,97 @@ class ShopifyProduct(models.Model):
         return None
 
     def export_to_shopify(self):
-        """Export product to Shopify"""
-        if not self.product_id:
+        """Export products to Shopify by chunks sent concurrently, return the Counter of results"""
+        if self.filtered(lambda p: not p.product_id):
             raise UserError(_("Please link an Odoo product first"))
 
-        headers = {
-            'X-Shopify-Access-Token': self.instance_id.access_token or self.instance_id.api_secret,
-            'Content-Type': 'application/json'
-        }
-
-        product_data = self._prepare_export_data()
+        Snapshot = self.env['shopify.stock.snapshot']
+        total = Counter(exported=0, failed=0)
+        for instance in self.mapped('instance_id'):
+            stats = Counter(exported=0, failed=0)
+            client = instance._get_api_client()
+            workers = min(instance.api_pool_size or EXPORT_MAX_WORKERS, EXPORT_MAX_WORKERS)
+            products = self.filtered(lambda p: p.instance_id == instance)
+
+            with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='shopify_export') as executor:
+                for chunk in split_every(EXPORT_CHUNK_SIZE, products.ids, self.browse):
+                    # Quantities and prices of every variant of the chunk in one pass
+                    odoo_variants = chunk.mapped('product_id.product_tmpl_id.product_variant_ids')
+                    quantities = Snapshot.get_product_quantities(odoo_variants, instance)
+                    prices = instance._compute_export_prices(odoo_variants)
+                    calls = [
+                        (product.shopify_id, product._prepare_export_data(quantities, prices))
+                        for product in chunk
+                    ]
+                    # Threads only do HTTP and never touch the ORM
+                    results = executor.map(lambda call: _send_product(client, *call), calls)
+
+                    exported = self.browse()
+                    new_shopify_ids = {}
+                    for product, (shopify_id, error) in zip(chunk, results):
+                        if error:
+                            stats['failed'] += 1
+                            self.env['shopify.log'].create({
+                                'instance_id': instance.id,
+                                'operation': 'product_export',
+                                'message': f'Error exporting product {product.name}: {error}',
+                                'status': 'error'
+                            })
+                            continue
+                        stats['exported'] += 1
+                        exported |= product
+                        if product.shopify_id != shopify_id:
+                            new_shopify_ids[product.id] = shopify_id
+                    self._write_shopify_ids(new_shopify_ids)
+                    exported.write({
+                        'last_sync': fields.Datetime.now(),
+                        'sync_required': False,
+                        'price_sync_required': False,
+                    })
 
-        if self.shopify_id:
-            # Update existing product
-            url = f"https://{self.instance_id.shop_url}/admin/api/2023-10/products/{self.shopify_id}.json"
-            response = requests.put(url, headers=headers, json=product_data, timeout=30)
-        else:
-            # Create new product
-            url = f"https://{self.instance_id.shop_url}/admin/api/2023-10/products.json"
-            response = requests.post(url, headers=headers, json=product_data, timeout=30)
-
-        if response.status_code in [200, 201]:
-            result = response.json()
-            self.shopify_id = str(result['product']['id'])
-            self.last_sync = fields.Datetime.now()
-            self.sync_required = False
-        else:
-            raise UserError(_("Failed to export product: %s") % response.text)
+            self.env['shopify.log'].create({
+                'instance_id': instance.id,
+                'operation': 'product_export',
+                'message': 'Products exported: %(exported)s exported, %(failed)s failed' % stats,
+                'status': 'warning' if stats['failed'] else 'success'
+            })
+            total.update(stats)
+        return total
 
-    def _prepare_export_data(self):
+    @api.model
+    def _write_shopify_ids(self, shopify_ids):
+        """Store the Shopify ids of newly exported products, by product id, in one statement"""
+        if not shopify_ids:
+            return
+        self.flush_model(['shopify_id'])
+        self.env.cr.execute(f"""
+            UPDATE shopify_product p
+            SET shopify_id = v.shopify_id
+            FROM (VALUES {', '.join(['(%s, %s)'] * len(shopify_ids))}) AS v(id, shopify_id)
+            WHERE p.id = v.id
+        """, [value for item in shopify_ids.items() for value in item])
+        self.invalidate_model(['shopify_id'])
+
+    def _prepare_export_data(self, quantities=None, prices=None):
         """Prepare product data for export to Shopify"""
         product = self.product_id
         template = product.product_tmpl_id
+        # Quantities and prices by product id, computed for a whole export
+        # chunk by the caller or else for this product only
+        if quantities is None:
+            quantities = self.env['shopify.stock.snapshot'].get_product_quantities(
+                template.product_variant_ids, self.instance_id
+            )
+        if prices is None:
+            prices = self.instance_id._compute_export_prices(template.product_variant_ids)
 
         variants = []
         for variant in template.product_variant_ids:
             variant_data = {
                 'title': variant.name,
-                'price': str(variant.list_price),
+                'price': str(prices[variant.id]),
                 'sku': variant.default_code or '',
-                'inventory_quantity': int(variant.qty_available),
+                'inventory_quantity': quantities.get(variant.id, 0),
                 'inventory_management': 'shopify'
             }
             variants.append(variant_data)
@@ -222,10 +559,130 @@ class ShopifyProduct(models.Model):
             }
         }
 
+    @api.model
+    def _mark_sync_required(self, templates, flag='sync_required'):
+        """Set ``flag`` (``sync_required`` or ``price_sync_required``) on the Shopify products of ``templates``"""
+        if not templates:
+            return
+        products = self.sudo().search([
+            (flag, '=', False),
+            '|', ('template_id', 'in', templates.ids),
+            ('product_id.product_tmpl_id', 'in', templates.ids),
+        ])
+        if products:
+            products.write({flag: True})
+
+    @api.model
+    def _cron_export_changed_products(self):
+        """Export the products flagged as changed, once however many times they were edited"""
+        instances = self.env['shopify.instance'].search([
+            ('is_active', '=', True),
+            ('auto_export_products', '=', True)
+        ])
+        for instance in instances:
+            products = self.search([
+                ('instance_id', '=', instance.id),
+                ('sync_required', '=', True),
+                ('product_id', '!=', False),
+            ], order='write_date', limit=DIRTY_EXPORT_BATCH_SIZE)
+            if products:
+                products.export_to_shopify()
+                # Failed products keep their flag, move them after the others
+                products.filtered('sync_required').write({'sync_required': True})
+
+            # Products whose price alone changed only get their prices updated
+            products = self.search([
+                ('instance_id', '=', instance.id),
+                ('price_sync_required', '=', True),
+                ('sync_required', '=', False),
+                ('shopify_id', '!=', False),
+            ], order='write_date', limit=DIRTY_EXPORT_BATCH_SIZE)
+            if products:
+                products.sync_prices()
+                products.filtered('price_sync_required').write({'price_sync_required': True})
+
+    def sync_prices(self):
+        """Push the changed variant prices to Shopify, one bulk update per product"""
+        total = Counter(updated=0, skipped=0, failed=0)
+        for instance in self.mapped('instance_id'):
+            stats = Counter(updated=0, skipped=0, failed=0)
+            products = self.filtered(lambda p: p.instance_id == instance and p.shopify_id)
+            variants = products.mapped('variant_ids').filtered('odoo_variant_id')
+            prices = variants._get_export_prices()
+            client = instance._get_api_client()
+            synced = self.browse()
+
+            for product in products:
+                changes = []
+                for variant in product.variant_ids.filtered(lambda v: v.id in prices):
+                    price, compare_at_price = prices[variant.id]
+                    if float_compare(price, variant.price, precision_digits=2) \
+                            or (compare_at_price is not None
+                                and float_compare(compare_at_price, variant.compare_at_price, precision_digits=2)):
+                        changes.append((variant, price, compare_at_price))
+                if not changes:
+                    stats['skipped'] += 1
+                    synced |= product
+                    continue
+
+                try:
+                    data = client.graphql(PRICE_UPDATE_MUTATION, {
+                        'productId': f'gid://shopify/Product/{product.shopify_id}',
+                        'variants': [
+                            self._get_price_update_input(variant, price, compare_at_price)
+                            for variant, price, compare_at_price in changes
+                        ],
+                    }, cost=PRICE_UPDATE_COST)
+                    errors = data['productVariantsBulkUpdate']['userErrors']
+                except UserError as e:
+                    errors = [{'message': str(e)}]
+                if errors:
+                    stats['failed'] += 1
+                    self.env['shopify.log'].create({
+                        'instance_id': instance.id,
+                        'operation': 'price_sync',
+                        'message': f'Error updating prices of {product.name}: '
+                                   + '; '.join(error['message'] for error in errors),
+                        'status': 'error'
+                    })
+                    continue
+
+                stats['updated'] += 1
+                synced |= product
+                for variant, price, compare_at_price in changes:
+                    vals = {'price': price}
+                    if compare_at_price is not None:
+                        vals['compare_at_price'] = compare_at_price
+                    variant.write(vals)
+            synced.filtered('price_sync_required').write({'price_sync_required': False})
+
+            self.env['shopify.log'].create({
+                'instance_id': instance.id,
+                'operation': 'price_sync',
+                'message': 'Prices synced: %(updated)s updated, %(skipped)s unchanged, '
+                           '%(failed)s failed' % stats,
+                'status': 'warning' if stats['failed'] else 'success'
+            })
+            total.update(stats)
+        return total
+
+    @api.model
+    def _get_price_update_input(self, variant, price, compare_at_price):
+        """Return the ``ProductVariantsBulkInput`` of a price update"""
+        variant_input = {
+            'id': f'gid://shopify/ProductVariant/{variant.shopify_id}',
+            'price': str(price),
+        }
+        # Without a compare-at price from Odoo, the one set in Shopify is kept
+        if compare_at_price is not None:
+            variant_input['compareAtPrice'] = str(compare_at_price) if compare_at_price else None
+        return variant_input
+
     def sync_stock_levels(self):
         """Sync stock levels with Shopify"""
-        for variant in self.variant_ids:
-            variant.sync_stock_level()
+        for instance in self.mapped('instance_id'):
+            products = self.filtered(lambda p: p.instance_id == instance)
+            self.env['shopify.stock.level'].sync_instance_stock(instance, products.mapped('variant_ids'))
 
     def action_sync_from_shopify(self):
         """Manual sync from Shopify"""
@@ -234,13 +691,26 @@ class ShopifyProduct(models.Model):
 
     def action_export_to_shopify(self):
         """Manual export to Shopify"""
-        self.export_to_shopify()
-        return True
+        stats = self.export_to_shopify()
+        if not stats['failed']:
+            return True
+        # Not raised: exported products must keep their new Shopify ID
+        return {
+            'type': 'ir.actions.client',
+            'tag': 'display_notification',
+            'params': {
+                'title': _('Export Failed'),
+                'message': _('%d product(s) could not be exported, see the Shopify logs') % stats['failed'],
+                'type': 'danger',
+            }
+        }
 
 
 class ShopifyProductVariant(models.Model):
     _name = 'shopify.product.variant'
     _description = 'Shopify Product Variant'
+    _inherit = ['shopify.mapping.mixin']
+    _shopify_scope_field = 'product_id'
 
     name = fields.Char('Variant Name', required=True)
     shopify_id = fields.Char('Shopify Variant ID', required=True)
@@ -255,6 +725,11 @@ class ShopifyProductVariant(models.Model):
     barcode = fields.Char('Barcode')
     grams = fields.Float('Weight (grams)')
     inventory_quantity = fields.Integer('Inventory Quantity')
+    inventory_item_id = fields.Char('Shopify Inventory Item ID')
+    stock_pending_since = fields.Datetime('Stock Push Requested', readonly=True, copy=False,
+                                          index='btree_not_null',
+                                          help="Set by stock moves, cleared once the stock has been pushed")
+    stock_push_error = fields.Char('Stock Push Error', readonly=True, copy=False)
     inventory_policy = fields.Char('Inventory Policy')
     fulfillment_service = fields.Char('Fulfillment Service')
     inventory_management = fields.Char('Inventory Management')
@@ -270,17 +745,11 @@ class ShopifyProductVariant(models.Model):
     last_sync = fields.Datetime('Last Sync')
 
     @api.model
-    def _create_or_update_variant(self, product, variant_data):
-        """Create or update variant from Shopify data"""
-        shopify_id = str(variant_data.get('id'))
-        existing_variant = self.search([
-            ('shopify_id', '=', shopify_id),
-            ('product_id', '=', product.id)
-        ], limit=1)
-
-        vals = {
+    def _prepare_variant_vals(self, product, variant_data):
+        """Prepare variant values from Shopify data"""
+        return {
             'name': variant_data.get('title'),
-            'shopify_id': shopify_id,
+            'shopify_id': str(variant_data.get('id')),
             'product_id': product.id,
             'title': variant_data.get('title'),
             'price': float(variant_data.get('price', 0)),
@@ -289,6 +758,7 @@ class ShopifyProductVariant(models.Model):
             'barcode': variant_data.get('barcode'),
             'grams': float(variant_data.get('grams', 0)),
             'inventory_quantity': int(variant_data.get('inventory_quantity', 0)),
+            'inventory_item_id': str(variant_data['inventory_item_id']) if variant_data.get('inventory_item_id') else False,
             'inventory_policy': variant_data.get('inventory_policy'),
             'fulfillment_service': variant_data.get('fulfillment_service'),
             'inventory_management': variant_data.get('inventory_management'),
@@ -300,50 +770,81 @@ class ShopifyProductVariant(models.Model):
             'last_sync': fields.Datetime.now()
         }
 
-        if existing_variant:
-            existing_variant.write(vals)
-            return existing_variant
-        else:
-            return self.create(vals)
-
     def sync_stock_level(self):
         """Sync stock level with Shopify"""
         if not self.odoo_variant_id:
             return
 
-        headers = {
-            'X-Shopify-Access-Token': self.product_id.instance_id.access_token or self.product_id.instance_id.api_secret,
-            'Content-Type': 'application/json'
-        }
-
-        # Get inventory item ID first
-        url = f"https://{self.product_id.instance_id.shop_url}/admin/api/2023-10/variants/{self.shopify_id}.json"
-        response = requests.get(url, headers=headers, timeout=30)
-
-        if response.status_code == 200:
-            variant_data = response.json()['variant']
-            inventory_item_id = variant_data.get('inventory_item_id')
-
-            if inventory_item_id:
-                # Update inventory level
-                inventory_data = {
-                    'location_id': self._get_default_location_id(),
-                    'inventory_item_id': inventory_item_id,
-                    'available': int(self.odoo_variant_id.qty_available)
-                }
+        self.env['shopify.stock.level'].sync_instance_stock(self.product_id.instance_id, self)
+
+    def _get_export_prices(self):
+        """Return the ``(price, compare_at_price)`` to publish for each variant id"""
+        result = {}
+        for instance in self.mapped('product_id.instance_id'):
+            variants = self.filtered(lambda v: v.product_id.instance_id == instance)
+            prices = instance._compute_export_prices(variants.mapped('odoo_variant_id'))
+            for variant in variants:
+                price = prices[variant.odoo_variant_id.id]
+                # None leaves the compare-at price to Shopify; when managed,
+                # the sales price of discounted variants is published
+                compare_at_price = None
+                if instance.manage_compare_at_price:
+                    sales_price = variant.odoo_variant_id.lst_price
+                    compare_at_price = sales_price if float_compare(sales_price, price, precision_digits=2) > 0 else 0.0
+                result[variant.id] = (price, compare_at_price)
+        return result
 
-                url = f"https://{self.product_id.instance_id.shop_url}/admin/api/2023-10/inventory_levels/set.json"
-                requests.post(url, headers=headers, json=inventory_data, timeout=30)
-
-    def _get_default_location_id(self):
-        """Get default Shopify location ID"""
-        # This should be stored in instance configuration
-        return 1  # Placeholder
+    @api.model
+    def _request_stock_push(self, products):
+        """Flag the variants mapped to ``products`` for the next stock push"""
+        if not products:
+            return
+        self.flush_model(['odoo_variant_id', 'product_id', 'stock_pending_since'])
+        # Plain SQL: flagging must not bump write_date, which marks the
+        # product lookup maps of order lines as stale. Variants already waiting
+        # keep their request time, so a burst of moves is pushed once
+        self.env.cr.execute("""
+            UPDATE shopify_product_variant v
+            SET stock_pending_since = (now() at time zone 'UTC')
+            FROM shopify_product p
+            JOIN shopify_instance i ON i.id = p.instance_id
+            WHERE p.id = v.product_id
+              AND i.is_active AND i.auto_sync_stock
+              AND v.odoo_variant_id IN %s
+              AND v.stock_pending_since IS NULL
+            RETURNING COALESCE(i.stock_push_delay, 0)
+        """, [tuple(products.ids)])
+        delays = [delay for delay, in self.env.cr.fetchall()]
+        if not delays:
+            return
+        self.invalidate_model(['stock_pending_since'])
+        cron = self.env.ref('shopify_integration.ir_cron_flush_stock_updates', raise_if_not_found=False)
+        if cron:
+            cron.sudo()._trigger(fields.Datetime.now() + timedelta(seconds=min(delays)))
+
+    def _fetch_inventory_item_id(self, client):
+        """Read and store the inventory item of a variant imported without it"""
+        response = client.get(f"variants/{self.shopify_id}.json")
+        if response.status_code != 200:
+            return False
+        inventory_item_id = response.json()['variant'].get('inventory_item_id')
+        if inventory_item_id:
+            self.inventory_item_id = str(inventory_item_id)
+        return self.inventory_item_id
+
+    def action_sync_stock(self):
+        """Manual stock push to Shopify"""
+        for instance in self.mapped('product_id.instance_id'):
+            variants = self.filtered(lambda v: v.product_id.instance_id == instance)
+            self.env['shopify.stock.level'].sync_instance_stock(instance, variants)
+        return True
 
 
 class ShopifyProductImage(models.Model):
     _name = 'shopify.product.image'
     _description = 'Shopify Product Image'
+    _inherit = ['shopify.mapping.mixin']
+    _shopify_scope_field = 'product_id'
 
     name = fields.Char('Image Name')
     shopify_id = fields.Char('Shopify Image ID', required=True)
@@ -360,27 +861,15 @@ class ShopifyProductImage(models.Model):
     variant_ids = fields.Many2many('shopify.product.variant', 'Image Variants')
 
     @api.model
-    def _create_or_update_image(self, product, image_data):
-        """Create or update image from Shopify data"""
-        shopify_id = str(image_data.get('id'))
-        existing_image = self.search([
-            ('shopify_id', '=', shopify_id),
-            ('product_id', '=', product.id)
-        ], limit=1)
-
-        vals = {
+    def _prepare_image_vals(self, product, image_data):
+        """Prepare image values from Shopify data"""
+        return {
             'name': image_data.get('alt') or f"Image {image_data.get('position', 1)}",
-            'shopify_id': shopify_id,
+            'shopify_id': str(image_data.get('id')),
             'product_id': product.id,
             'position': image_data.get('position'),
             'alt_text': image_data.get('alt'),
             'width': image_data.get('width'),
             'height': image_data.get('height'),
             'src': image_data.get('src')
-        }
-
-        if existing_image:
-            existing_image.write(vals)
-            return existing_image
-        else:
-            return self.create(vals)
\ No newline at end of file
+        }
\ No newline at end of file
@@ -153,46 +153,49 @@ class ShopifyQueue(models.Model):
 
     def _import_products(self, data):
         """Import products from Shopify"""
-        self.env['shopify.product'].import_from_shopify(self.instance_id)
-        return {'status': 'success', 'message': 'Products imported successfully'}
+        stats = self.env['shopify.product'].import_from_shopify(
+            self.instance_id, full_sync=data.get('full_sync', False)
+        )
+        return dict(stats or {}, status='success', message='Products imported successfully')
 
     def _export_products(self, data):
         """Export products to Shopify"""
-        products = data.get('product_ids', [])
-        if products:
-            products = self.env['shopify.product'].browse(products)
-            for product in products:
-                product.export_to_shopify()
-        return {'status': 'success', 'message': f'Exported {len(products)} products'}
+        if data.get('export_all'):
+            products = self.env['shopify.product'].search([
+                ('instance_id', '=', self.instance_id.id),
+                ('product_id', '!=', False)
+            ])
+        else:
+            products = self.env['shopify.product'].browse(data.get('product_ids', []))
+        stats = products.export_to_shopify() if products else {'exported': 0, 'failed': 0}
+        return dict(stats, status='success',
+                    message='Products exported: %(exported)s exported, %(failed)s failed' % stats)
 
     def _import_orders(self, data):
         """Import orders from Shopify"""
-        self.env['shopify.order'].import_from_shopify(self.instance_id)
-        return {'status': 'success', 'message': 'Orders imported successfully'}
+        stats = self.env['shopify.order'].import_from_shopify(self.instance_id)
+        return dict(stats or {}, status='success', message='Orders imported successfully')
 
     def _import_customers(self, data):
         """Import customers from Shopify"""
-        self.env['shopify.customer'].import_from_shopify(self.instance_id)
-        return {'status': 'success', 'message': 'Customers imported successfully'}
+        stats = self.env['shopify.customer'].import_from_shopify(self.instance_id)
+        return dict(stats or {}, status='success', message='Customers imported successfully')
 
     def _sync_stock(self, data):
         """Sync stock levels"""
-        products = self.env['shopify.product'].search([
-            ('instance_id', '=', self.instance_id.id)
-        ])
-        for product in products:
-            product.sync_stock_levels()
-        return {'status': 'success', 'message': f'Synced stock for {len(products)} products'}
+        stats = self.env['shopify.stock.level'].sync_instance_stock(self.instance_id)
+        return dict(stats, status='success',
+                    message='Stock synced: %(pushed)s pushed, %(skipped)s unchanged' % stats)
 
     def _sync_prices(self, data):
         """Sync prices"""
         products = self.env['shopify.product'].search([
-            ('instance_id', '=', self.instance_id.id)
+            ('instance_id', '=', self.instance_id.id),
+            ('price_sync_required', '=', True)
         ])
-        for product in products:
-            if product.sync_required:
-                product.export_to_shopify()
-        return {'status': 'success', 'message': f'Synced prices for {len(products)} products'}
+        stats = products.sync_prices()
+        return dict(stats, status='success',
+                    message='Prices synced: %(updated)s updated, %(skipped)s unchanged' % stats)
 
     def _process_webhook(self, data):
         """Process webhook data"""
@@ -0,0 +1,274 @@
+from odoo import models, fields, api, _
+from odoo.exceptions import UserError
+import logging
+from collections import Counter, defaultdict
+from datetime import timedelta
+
+from odoo.tools import split_every
+
+_logger = logging.getLogger(__name__)
+
+# Variants pushed per instance and per run of the pending stock cron
+STOCK_FLUSH_BATCH_SIZE = 1000
+
+# Maximum number of quantities accepted by one inventorySetQuantities call
+INVENTORY_SET_BATCH_SIZE = 250
+# Points reserved in the GraphQL cost bucket per inventorySetQuantities call
+INVENTORY_SET_COST = 10
+
+INVENTORY_SET_MUTATION = """
+mutation inventorySetQuantities($input: InventorySetQuantitiesInput!) {
+  inventorySetQuantities(input: $input) {
+    userErrors { field message }
+  }
+}
+"""
+
+
+class ShopifyStockLevel(models.Model):
+    _name = 'shopify.stock.level'
+    _description = 'Shopify Pushed Stock Level'
+    _rec_name = 'variant_id'
+    _order = 'variant_id, location_id'
+
+    variant_id = fields.Many2one('shopify.product.variant', 'Shopify Variant', required=True,
+                                 ondelete='cascade', index=True)
+    location_id = fields.Many2one('shopify.location', 'Shopify Location', required=True, ondelete='cascade')
+    quantity = fields.Integer('Pushed Quantity', help="Available quantity last sent to Shopify")
+    pushed_at = fields.Datetime('Pushed At')
+
+    _sql_constraints = [
+        ('variant_location_uniq', 'unique(variant_id, location_id)',
+         'There can only be one stock level per variant and location.'),
+    ]
+
+    @api.model
+    def sync_instance_stock(self, instance, variants=None):
+        """Push the changed stock of ``variants`` of ``instance``, all mapped ones by default"""
+        stats = Counter(pushed=0, skipped=0, failed=0)
+        try:
+            if variants is None:
+                variants = self.env['shopify.product.variant'].search([
+                    ('product_id.instance_id', '=', instance.id),
+                    ('odoo_variant_id', '!=', False),
+                ])
+            variants = variants.filtered('odoo_variant_id')
+            if not variants:
+                return stats
+
+            # First run: fetch the locations, a single one is mapped to the default warehouse
+            locations = instance.location_ids or self.env['shopify.location'].import_from_shopify(instance)
+            locations = locations.filtered(lambda l: l._get_stock_location())
+            if not locations:
+                raise UserError(_("No Shopify location is mapped to an Odoo warehouse or location"))
+
+            quantities = self.env['shopify.stock.snapshot'].get_variant_quantities(variants, locations)
+            levels = {
+                (level.variant_id.id, level.location_id.id): level
+                for level in self.search([('variant_id', 'in', variants.ids), ('location_id', 'in', locations.ids)])
+            }
+
+            client = instance._get_api_client()
+            now = fields.Datetime.now()
+            errors = {}
+            missing = set()
+            new_levels = []
+            for location in locations:
+                location_quantities = {variant.id: quantities[variant.id, location.id] for variant in variants}
+                # Only quantities differing from the last one pushed are sent
+                changes = []
+                for variant in variants:
+                    level = levels.get((variant.id, location.id))
+                    if level and level.quantity == location_quantities[variant.id]:
+                        stats['skipped'] += 1
+                    elif variant in missing:
+                        stats['failed'] += 1
+                    elif variant.inventory_item_id or variant._fetch_inventory_item_id(client):
+                        changes.append(variant)
+                    else:
+                        errors[variant] = _("No inventory item found on Shopify")
+                        missing.add(variant)
+                        stats['failed'] += 1
+
+                if instance.stock_push_backend == 'graphql':
+                    push_errors = self._push_quantities_graphql(client, location.shopify_id, changes, location_quantities)
+                else:
+                    push_errors = self._push_quantities_rest(client, location.shopify_id, changes, location_quantities)
+                errors.update(push_errors)
+                stats['failed'] += len(push_errors)
+
+                for variant in changes:
+                    if variant in push_errors:
+                        continue
+                    stats['pushed'] += 1
+                    level = levels.get((variant.id, location.id))
+                    if level:
+                        level.write({'quantity': location_quantities[variant.id], 'pushed_at': now})
+                    else:
+                        new_levels.append({
+                            'variant_id': variant.id,
+                            'location_id': location.id,
+                            'quantity': location_quantities[variant.id],
+                            'pushed_at': now,
+                        })
+            self.create(new_levels)
+
+            for variant, error in errors.items():
+                _logger.warning("Stock push failed for Shopify variant %s: %s", variant.shopify_id, error)
+                variant.stock_push_error = error
+            variants.filtered(lambda v: v.stock_push_error and v not in errors).stock_push_error = False
+
+            self.env['shopify.log'].create({
+                'instance_id': instance.id,
+                'operation': 'stock_sync',
+                'message': 'Stock synced: %(pushed)s pushed, %(skipped)s unchanged, '
+                           '%(failed)s failed' % stats,
+                'status': 'warning' if stats['failed'] else 'success'
+            })
+
+        except Exception as e:
+            self.env['shopify.log'].create({
+                'instance_id': instance.id,
+                'operation': 'stock_sync',
+                'message': f'Error syncing stock: {str(e)}',
+                'status': 'error'
+            })
+        return stats
+
+    @api.model
+    def _push_quantities_rest(self, client, location_id, variants, quantities):
+        """Set quantities with one ``inventory_levels/set`` call per variant, return the errors by variant"""
+        errors = {}
+        for variant in variants:
+            response = client.post('inventory_levels/set.json', json={
+                'location_id': location_id,
+                'inventory_item_id': variant.inventory_item_id,
+                'available': quantities[variant.id],
+            })
+            if response.status_code != 200:
+                errors[variant] = response.text
+        return errors
+
+    @api.model
+    def _push_quantities_graphql(self, client, location_id, variants, quantities):
+        """Set quantities with ``inventorySetQuantities`` by batches, return the errors by variant"""
+        errors = {}
+        for batch in split_every(INVENTORY_SET_BATCH_SIZE, variants):
+            try:
+                data = client.graphql(INVENTORY_SET_MUTATION, {'input': {
+                    'name': 'available',
+                    'reason': 'correction',
+                    'ignoreCompareQuantity': True,
+                    'quantities': [{
+                        'inventoryItemId': f'gid://shopify/InventoryItem/{variant.inventory_item_id}',
+                        'locationId': f'gid://shopify/Location/{location_id}',
+                        'quantity': quantities[variant.id],
+                    } for variant in batch],
+                }}, cost=INVENTORY_SET_COST)
+            except UserError as e:
+                errors.update((variant, str(e)) for variant in batch)
+                continue
+            for error in data['inventorySetQuantities']['userErrors']:
+                # Item errors point at their entry: ['input', 'quantities', '3', ...]
+                path = error.get('field') or []
+                if len(path) > 2 and path[1] == 'quantities' and str(path[2]).isdigit() \
+                        and int(path[2]) < len(batch):
+                    errors[batch[int(path[2])]] = error['message']
+                else:
+                    errors.update((variant, error['message']) for variant in batch)
+        return errors
+
+    @api.model
+    def _cron_flush_pending_stock(self):
+        """Push the stock of variants flagged by stock moves longer than ``stock_push_delay`` ago"""
+        instances = self.env['shopify.instance'].search([
+            ('is_active', '=', True),
+            ('auto_sync_stock', '=', True)
+        ])
+        Variant = self.env['shopify.product.variant']
+        Variant.flush_model(['stock_pending_since'])
+        now = fields.Datetime.now()
+        backlog = False
+
+        for instance in instances:
+            # Flags are cleared before pushing, so a move done meanwhile flags
+            # the variant again; failed pushes are left to the periodic sync
+            self.env.cr.execute("""
+                UPDATE shopify_product_variant
+                SET stock_pending_since = NULL
+                WHERE id IN (
+                    SELECT v.id
+                    FROM shopify_product_variant v
+                    JOIN shopify_product p ON p.id = v.product_id
+                    WHERE p.instance_id = %s AND v.stock_pending_since <= %s
+                    ORDER BY v.stock_pending_since
+                    LIMIT %s
+                    FOR UPDATE OF v SKIP LOCKED
+                )
+                RETURNING id
+            """, [instance.id, now - timedelta(seconds=instance.stock_push_delay or 0), STOCK_FLUSH_BATCH_SIZE])
+            variant_ids = [variant_id for variant_id, in self.env.cr.fetchall()]
+            if not variant_ids:
+                continue
+            Variant.invalidate_model(['stock_pending_since'])
+            self.sync_instance_stock(instance, Variant.browse(variant_ids))
+            backlog = backlog or len(variant_ids) == STOCK_FLUSH_BATCH_SIZE
+
+        if backlog:
+            self.env.ref('shopify_integration.ir_cron_flush_stock_updates')._trigger()
+
+
+class ShopifyStockSnapshot(models.AbstractModel):
+    """On hand quantities of many products and locations, summed with one grouped read"""
+    _name = 'shopify.stock.snapshot'
+    _description = 'Shopify Stock Snapshot'
+
+    @api.model
+    def get_variant_quantities(self, variants, locations):
+        """Return a dict mapping ``(variant id, shopify.location id)`` to the on hand quantity"""
+        stock_locations = {location.id: location._get_stock_location() for location in locations}
+        on_hand = self._get_quantities(variants.mapped('odoo_variant_id'), stock_locations)
+        return {
+            (variant.id, location.id): int(on_hand[variant.odoo_variant_id.id, location.id])
+            for variant in variants for location in locations
+        }
+
+    @api.model
+    def get_product_quantities(self, products, instance):
+        """Return the on hand quantity of each product over the locations of ``instance``"""
+        stock_locations = {
+            location.id: location._get_stock_location()
+            for location in instance.location_ids if location._get_stock_location()
+        }
+        # Before any location is mapped, the default warehouse stands for the shop
+        if not stock_locations and instance.warehouse_id:
+            stock_locations = {0: instance.warehouse_id.lot_stock_id}
+        if not stock_locations:
+            return {product.id: int(product.qty_available) for product in products}
+
+        on_hand = self._get_quantities(products, stock_locations)
+        return {
+            product.id: int(sum(on_hand[product.id, key] for key in stock_locations))
+            for product in products
+        }
+
+    @api.model
+    def _get_quantities(self, products, stock_locations):
+        """Return the quants of ``products`` summed by ``(product id, key)`` of ``stock_locations``"""
+        on_hand = defaultdict(float)
+        if not products or not stock_locations:
+            return on_hand
+        groups = self.env['stock.quant'].read_group(
+            [('product_id', 'in', products.ids),
+             ('location_id', 'child_of', [location.id for location in stock_locations.values()])],
+            ['quantity:sum'], ['product_id', 'location_id'], lazy=False,
+        )
+
+        quant_locations = self.env['stock.location'].browse({group['location_id'][0] for group in groups})
+        paths = {location.id: location.parent_path for location in quant_locations}
+        for group in groups:
+            path = paths[group['location_id'][0]]
+            for key, stock_location in stock_locations.items():
+                if path.startswith(stock_location.parent_path):
+                    on_hand[group['product_id'][0], key] += group['quantity']
+        return on_hand
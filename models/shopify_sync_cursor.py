@@ -0,0 +1,62 @@
+from odoo import models, fields, api
+
+from .shopify_api import parse_datetime
+
+
+def advance_watermark(watermark, record_data):
+    """Return the highest ``(updated_at, id)`` pair of ``watermark`` and ``record_data``"""
+    updated_at = parse_datetime(record_data.get('updated_at'))
+    if not updated_at:
+        return watermark
+    candidate = (updated_at, int(record_data.get('id') or 0))
+    return max(watermark, candidate) if watermark else candidate
+
+
+class ShopifySyncCursor(models.Model):
+    _name = 'shopify.sync.cursor'
+    _description = 'Shopify Sync Cursor'
+    _rec_name = 'resource'
+    _order = 'instance_id, resource'
+
+    instance_id = fields.Many2one('shopify.instance', 'Shopify Instance', required=True, ondelete='cascade')
+    resource = fields.Selection([
+        ('products', 'Products'),
+        ('orders', 'Orders'),
+        ('customers', 'Customers'),
+    ], required=True, string='Resource')
+
+    last_updated_at = fields.Datetime('Last Updated At', help="Highest Shopify updated_at imported so far")
+    last_id = fields.Char('Last Record ID', help="Shopify ID of the record carrying Last Updated At")
+    last_run = fields.Datetime('Last Run')
+
+    _sql_constraints = [
+        ('instance_resource_uniq', 'unique(instance_id, resource)',
+         'There can only be one sync cursor per instance and resource.'),
+    ]
+
+    @api.model
+    def _get_cursor(self, instance, resource):
+        """Return the cursor of ``resource`` for ``instance``, creating it if needed"""
+        cursor = self.search([
+            ('instance_id', '=', instance.id),
+            ('resource', '=', resource)
+        ], limit=1)
+        if not cursor:
+            cursor = self.create({'instance_id': instance.id, 'resource': resource})
+        return cursor
+
+    def _advance(self, watermark):
+        """Store the watermark reached by a successful run"""
+        self.ensure_one()
+        vals = {'last_run': fields.Datetime.now()}
+        if watermark and (not self.last_updated_at or watermark[0] >= self.last_updated_at):
+            vals.update({
+                'last_updated_at': watermark[0],
+                'last_id': str(watermark[1]),
+            })
+        self.write(vals)
+
+    def action_reset(self):
+        """Forget the watermark so the next run is a full resync"""
+        self.write({'last_updated_at': False, 'last_id': False})
+        return True
@@ -1,11 +1,55 @@
-from odoo import models, fields, api, _
+from odoo import models, fields, api, tools, _
 from odoo.exceptions import ValidationError, UserError
 import json
 import logging
+import threading
+from collections import OrderedDict, defaultdict
 from datetime import datetime, timedelta
 
+from .shopify_api import parse_datetime
+
 _logger = logging.getLogger(__name__)
 
+# Inbox rows claimed per transaction by the webhook worker
+INBOX_BATCH_SIZE = 50
+# Deliveries failing this many times are left for manual review
+INBOX_MAX_ATTEMPTS = 3
+# Delay before retrying a failed delivery, doubled on each attempt
+INBOX_RETRY_DELAY = 60
+
+# Topics whose bursts are collapsed to the latest update of each resource,
+# with the model storing that resource
+COALESCED_TOPICS = {
+    'orders/create': 'shopify.order',
+    'orders/updated': 'shopify.order',
+    'products/create': 'shopify.product',
+    'products/update': 'shopify.product',
+}
+
+# Delivery ids recently stored in the inbox, per database and per worker, so
+# that retries of a hot delivery are rejected without querying the database
+SEEN_DELIVERIES_SIZE = 10000
+_seen_deliveries = OrderedDict()
+_seen_deliveries_lock = threading.Lock()
+
+
+def _is_seen_delivery(dbname, webhook_id):
+    key = (dbname, webhook_id)
+    with _seen_deliveries_lock:
+        if key in _seen_deliveries:
+            _seen_deliveries.move_to_end(key)
+            return True
+    return False
+
+
+def _add_seen_delivery(dbname, webhook_id):
+    key = (dbname, webhook_id)
+    with _seen_deliveries_lock:
+        _seen_deliveries[key] = True
+        _seen_deliveries.move_to_end(key)
+        while len(_seen_deliveries) > SEEN_DELIVERIES_SIZE:
+            _seen_deliveries.popitem(last=False)
+
 
 class ShopifyWebhook(models.Model):
     _name = 'shopify.webhook'
@@ -41,6 +85,8 @@ class ShopifyWebhook(models.Model):
     total_calls = fields.Integer('Total Calls', default=0)
     successful_calls = fields.Integer('Successful Calls', default=0)
     failed_calls = fields.Integer('Failed Calls', default=0)
+    duplicate_calls = fields.Integer('Duplicate Calls', default=0,
+                                     help="Deliveries received again and ignored")
     last_call = fields.Datetime('Last Call')
     
     # Logs
@@ -51,11 +97,7 @@ class ShopifyWebhook(models.Model):
         """Process incoming webhook"""
         try:
             # Find webhook configuration
-            webhook = self.search([
-                ('topic', '=', topic),
-                ('instance_id', '=', instance_id),
-                ('state', '=', 'active')
-            ], limit=1)
+            webhook = self.browse(self._get_active_webhook_id(instance_id, topic))
             
             if not webhook:
                 _logger.warning(f"No active webhook found for topic {topic}")
@@ -73,16 +115,13 @@ class ShopifyWebhook(models.Model):
             # Process based on topic
             result = self._process_by_topic(topic, data, instance_id)
             
-            # Update statistics
-            webhook.total_calls += 1
-            webhook.last_call = fields.Datetime.now()
+            # Statistics are rolled up from the counters in the background
+            self.env['shopify.webhook.counter']._record(webhook.id, 'success' if result else 'failed')
             
             if result:
-                webhook.successful_calls += 1
                 webhook_log.status = 'success'
                 webhook_log.response = 'Processed successfully'
             else:
-                webhook.failed_calls += 1
                 webhook_log.status = 'failed'
                 webhook_log.response = 'Processing failed'
             
@@ -95,6 +134,33 @@ class ShopifyWebhook(models.Model):
                 webhook_log.response = str(e)
             return False
     
+    @api.model_create_multi
+    def create(self, vals_list):
+        records = super().create(vals_list)
+        self.clear_caches()
+        return records
+
+    def write(self, vals):
+        res = super().write(vals)
+        if {'topic', 'instance_id', 'state'} & set(vals):
+            self.clear_caches()
+        return res
+
+    def unlink(self):
+        res = super().unlink()
+        self.clear_caches()
+        return res
+
+    @api.model
+    @tools.ormcache('instance_id', 'topic')
+    def _get_active_webhook_id(self, instance_id, topic):
+        """Return the id of the active webhook of ``topic``, or None (cached)"""
+        return self.sudo().search([
+            ('topic', '=', topic),
+            ('instance_id', '=', instance_id),
+            ('state', '=', 'active')
+        ], limit=1).id or None
+
     def _process_by_topic(self, topic, data, instance_id):
         """Process webhook based on topic"""
         instance = self.env['shopify.instance'].browse(instance_id)
@@ -128,7 +194,8 @@ class ShopifyWebhook(models.Model):
         """Process order created webhook"""
         try:
             shopify_order = self.env['shopify.order']._create_or_update_order(instance, data)
-            if instance.auto_import_orders and not shopify_order.imported:
+            if shopify_order and instance.auto_import_orders and not shopify_order.imported \
+                    and shopify_order._is_open():
                 shopify_order.create_sale_order()
             return True
         except Exception as e:
@@ -198,7 +265,7 @@ class ShopifyWebhook(models.Model):
         """Process customer created webhook"""
         try:
             customer = self.env['shopify.customer']._create_or_update_customer(instance, data)
-            if instance.auto_import_customers and not customer.imported:
+            if customer and instance.auto_import_customers and not customer.imported:
                 customer.create_partner()
             return True
         except Exception as e:
@@ -241,6 +308,63 @@ class ShopifyWebhook(models.Model):
         }
 
 
+class ShopifyWebhookCounter(models.Model):
+    """Append-only call counters, rolled up into the statistics of their webhook"""
+    # One row per call rather than an increment, so concurrent workers never
+    # wait on the same webhook row
+    _name = 'shopify.webhook.counter'
+    _description = 'Shopify Webhook Call Counter'
+    _log_access = False
+
+    webhook_id = fields.Many2one('shopify.webhook', 'Webhook', required=True, ondelete='cascade')
+    status = fields.Selection([
+        ('success', 'Success'),
+        ('failed', 'Failed'),
+        ('duplicate', 'Duplicate')
+    ], required=True, string='Status')
+    call_date = fields.Datetime('Call Date', required=True)
+
+    @api.model
+    def _record(self, webhook_id, status):
+        """Count one call of ``webhook_id``"""
+        self.env.cr.execute("""
+            INSERT INTO shopify_webhook_counter (webhook_id, status, call_date)
+            VALUES (%s, %s, now() at time zone 'UTC')
+        """, [webhook_id, status])
+
+    @api.model
+    def _cron_rollup(self):
+        """Move the counters into the statistics of their webhook"""
+        # Deleted and summed in one statement: each row is counted exactly
+        # once even with concurrent runs
+        self.env.cr.execute("""
+            WITH counters AS (
+                DELETE FROM shopify_webhook_counter
+                RETURNING webhook_id, status, call_date
+            ), totals AS (
+                SELECT webhook_id,
+                       COUNT(*) FILTER (WHERE status != 'duplicate') AS total,
+                       COUNT(*) FILTER (WHERE status = 'success') AS successful,
+                       COUNT(*) FILTER (WHERE status = 'failed') AS failed,
+                       COUNT(*) FILTER (WHERE status = 'duplicate') AS duplicate,
+                       MAX(call_date) FILTER (WHERE status != 'duplicate') AS last_call
+                FROM counters
+                GROUP BY webhook_id
+            )
+            UPDATE shopify_webhook w
+            SET total_calls = COALESCE(w.total_calls, 0) + t.total,
+                successful_calls = COALESCE(w.successful_calls, 0) + t.successful,
+                failed_calls = COALESCE(w.failed_calls, 0) + t.failed,
+                duplicate_calls = COALESCE(w.duplicate_calls, 0) + t.duplicate,
+                last_call = GREATEST(w.last_call, t.last_call)
+            FROM totals t
+            WHERE w.id = t.webhook_id
+        """)
+        self.env['shopify.webhook'].invalidate_model(
+            ['total_calls', 'successful_calls', 'failed_calls', 'duplicate_calls', 'last_call']
+        )
+
+
 class ShopifyWebhookLog(models.Model):
     _name = 'shopify.webhook.log'
     _description = 'Shopify Webhook Log'
@@ -268,4 +392,198 @@ class ShopifyWebhookLog(models.Model):
         cutoff_date = fields.Datetime.now() - timedelta(days=days)
         old_logs = self.search([('create_date', '<', cutoff_date)])
         old_logs.unlink()
-        return True
\ No newline at end of file
+        return True
+
+
+class ShopifyWebhookInbox(models.Model):
+    """Webhook deliveries acknowledged to Shopify and waiting to be processed"""
+    _name = 'shopify.webhook.inbox'
+    _description = 'Shopify Webhook Inbox'
+    _rec_name = 'topic'
+    _order = 'id'
+
+    instance_id = fields.Many2one('shopify.instance', 'Shopify Instance', required=True, ondelete='cascade')
+    topic = fields.Char('Topic', required=True)
+    webhook_id = fields.Char('Shopify Webhook ID', help="X-Shopify-Webhook-Id of the delivery")
+    body = fields.Text('Body', required=True)
+    headers = fields.Text('Headers')
+
+    coalesce_key = fields.Char('Coalescing Key', index=True,
+                               help="Model and Shopify id of the updated resource, for coalesced topics")
+    resource_updated_at = fields.Datetime('Resource Updated At', help="updated_at of the delivered payload")
+
+    state = fields.Selection([
+        ('pending', 'Pending'),
+        ('done', 'Done'),
+        ('superseded', 'Superseded'),
+        ('failed', 'Failed')
+    ], default='pending', required=True, string='Status', index=True)
+    attempts = fields.Integer('Attempts', default=0)
+    next_attempt_at = fields.Datetime('Next Attempt', help="Failed deliveries are not retried before this time")
+    error = fields.Text('Error')
+    processed_at = fields.Datetime('Processed At')
+
+    _sql_constraints = [
+        ('webhook_id_uniq', 'unique(webhook_id)', 'This webhook delivery has already been received.'),
+    ]
+
+    @api.model
+    def _enqueue(self, instance_id, topic, body, headers, coalesce_window=0):
+        """Store a verified delivery and wake up the worker, return False for a duplicate"""
+        # Shopify delivers at least once: a delivery already received is caught
+        # by the recent deliveries of the worker, or else by the unique index
+        webhook_id = headers.get('X-Shopify-Webhook-Id')
+        dbname = self.env.cr.dbname
+        if webhook_id and _is_seen_delivery(dbname, webhook_id):
+            self._count_duplicate(instance_id, topic)
+            return False
+
+        coalesce_key, updated_at = self._get_coalesce_key(topic, body)
+        self.env.cr.execute("""
+            INSERT INTO shopify_webhook_inbox
+                (instance_id, topic, webhook_id, body, headers, coalesce_key, resource_updated_at,
+                 state, attempts, create_uid, create_date, write_uid, write_date)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, 'pending', 0,
+                    %s, now() at time zone 'UTC', %s, now() at time zone 'UTC')
+            ON CONFLICT (webhook_id) DO NOTHING
+            RETURNING id
+        """, [instance_id, topic, webhook_id, body, json.dumps(headers), coalesce_key, updated_at,
+              self.env.uid, self.env.uid])
+        row = self.env.cr.fetchone()
+        if not row:
+            _add_seen_delivery(dbname, webhook_id)
+            self._count_duplicate(instance_id, topic)
+            return False
+
+        if webhook_id:
+            self.env.cr.postcommit.add(lambda: _add_seen_delivery(dbname, webhook_id))
+        # Coalesced deliveries wait ``coalesce_window`` seconds for later updates
+        at = None
+        if coalesce_key:
+            at = fields.Datetime.now() + timedelta(seconds=coalesce_window or 0)
+        self.env.ref('shopify_integration.ir_cron_process_webhook_inbox').sudo()._trigger(at)
+        return self.browse(row[0])
+
+    @api.model
+    def _get_coalesce_key(self, topic, body):
+        """Return the coalescing key and ``updated_at`` of a delivery, or ``(None, None)``"""
+        # Deliveries without a key are processed one by one
+        model = COALESCED_TOPICS.get(topic)
+        if not model:
+            return None, None
+        try:
+            data = json.loads(body)
+            updated_at = parse_datetime(data.get('updated_at'))
+        except ValueError:
+            return None, None
+        if not data.get('id') or not updated_at:
+            return None, None
+        return f"{model},{data['id']}", updated_at
+
+    @api.model
+    def _count_duplicate(self, instance_id, topic):
+        """Count a duplicate delivery on the matching webhook"""
+        _logger.info("Duplicate webhook %s ignored for instance %s", topic, instance_id)
+        webhook_id = self.env['shopify.webhook']._get_active_webhook_id(instance_id, topic)
+        if webhook_id:
+            self.env['shopify.webhook.counter']._record(webhook_id, 'duplicate')
+
+    @api.model
+    def _cron_process_inbox(self):
+        """Process pending deliveries in batches, retrying failed ones with a backoff"""
+        Webhook = self.env['shopify.webhook']
+        retry_at = None
+        while True:
+            # SKIP LOCKED lets several workers drain the inbox concurrently;
+            # coalesced deliveries wait for the coalescing window of the instance
+            self.env.cr.execute("""
+                SELECT w.id
+                FROM shopify_webhook_inbox w
+                JOIN shopify_instance i ON i.id = w.instance_id
+                WHERE w.state = 'pending'
+                  AND (w.next_attempt_at IS NULL OR w.next_attempt_at <= now() at time zone 'UTC')
+                  AND (w.coalesce_key IS NULL
+                       OR w.create_date <= now() at time zone 'UTC'
+                                           - make_interval(secs => COALESCE(i.webhook_coalesce_window, 0)))
+                ORDER BY w.id
+                LIMIT %s
+                FOR UPDATE OF w SKIP LOCKED
+            """, [INBOX_BATCH_SIZE])
+            deliveries = self.browse([row[0] for row in self.env.cr.fetchall()])
+            if not deliveries:
+                break
+
+            superseded = deliveries._get_superseded()
+            superseded.write({'state': 'superseded', 'processed_at': fields.Datetime.now()})
+
+            # Each delivery runs in a savepoint, each batch is committed on its own
+            for delivery in deliveries - superseded:
+                error = False
+                try:
+                    with self.env.cr.savepoint():
+                        result = Webhook.process_webhook(
+                            delivery.topic, json.loads(delivery.body),
+                            json.loads(delivery.headers or '{}'), delivery.instance_id.id
+                        )
+                    if not result:
+                        error = _("Webhook processing failed")
+                except Exception as e:
+                    error = str(e)
+
+                attempts = delivery.attempts + 1
+                vals = {
+                    'state': 'done' if not error else ('failed' if attempts >= INBOX_MAX_ATTEMPTS else 'pending'),
+                    'attempts': attempts,
+                    'error': error,
+                    'processed_at': fields.Datetime.now(),
+                    'next_attempt_at': False,
+                }
+                if vals['state'] == 'pending':
+                    # Give transient causes (e.g. an order received before its
+                    # product) time to resolve before the next attempt
+                    vals['next_attempt_at'] = fields.Datetime.now() + timedelta(
+                        seconds=INBOX_RETRY_DELAY * 2 ** (attempts - 1))
+                    retry_at = min(retry_at or vals['next_attempt_at'], vals['next_attempt_at'])
+                delivery.write(vals)
+            self.env.cr.commit()
+
+        if retry_at:
+            self.env.ref('shopify_integration.ir_cron_process_webhook_inbox')._trigger(retry_at)
+
+    def _get_superseded(self):
+        """Return the deliveries of ``self`` followed by a later update or older than the stored resource"""
+        latest = {}
+        for delivery in self.filtered('coalesce_key'):
+            key = (delivery.instance_id.id, delivery.coalesce_key)
+            current = latest.get(key)
+            if not current or (delivery.resource_updated_at, delivery.id) > (current.resource_updated_at, current.id):
+                latest[key] = delivery
+        superseded = self.filtered('coalesce_key') - self.browse([delivery.id for delivery in latest.values()])
+
+        resource_ids = defaultdict(set)
+        for instance_id, coalesce_key in latest:
+            model, shopify_id = coalesce_key.split(',')
+            resource_ids[model].add(shopify_id)
+        stored = {}
+        for model, shopify_ids in resource_ids.items():
+            for record in self.env[model].search([('shopify_id', 'in', list(shopify_ids))]):
+                stored[record.instance_id.id, f"{model},{record.shopify_id}"] = record.shopify_updated_at
+
+        for key, delivery in latest.items():
+            if stored.get(key) and delivery.resource_updated_at < stored[key]:
+                _logger.info("Stale webhook %s discarded for %s", delivery.topic, delivery.coalesce_key)
+                superseded |= delivery
+        return superseded
+
+    @api.model
+    def cleanup_processed(self, days=7):
+        """Delete processed deliveries older than ``days``"""
+        cutoff_date = fields.Datetime.now() - timedelta(days=days)
+        self.search([('state', 'in', ('done', 'superseded')), ('processed_at', '<', cutoff_date)]).unlink()
+        return True
+
+    def action_retry(self):
+        """Queue failed deliveries again"""
+        self.write({'state': 'pending', 'attempts': 0, 'error': False, 'next_attempt_at': False})
+        self.env.ref('shopify_integration.ir_cron_process_webhook_inbox')._trigger()
+        return True
@@ -0,0 +1,11 @@
+from odoo import models
+
+
+class StockMove(models.Model):
+    _inherit = 'stock.move'
+
+    def _action_done(self, cancel_backorder=False):
+        moves = super()._action_done(cancel_backorder=cancel_backorder)
+        products = moves.mapped('product_id').filtered(lambda p: p.type == 'product')
+        self.env['shopify.product.variant']._request_stock_push(products)
+        return moves
@@ -0,0 +1,2 @@
+from . import test_product_import
+from . import test_order_import
@@ -0,0 +1,15 @@
+from odoo.tests import TransactionCase
+
+
+class ShopifyTestCommon(TransactionCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.instance = cls.env['shopify.instance'].create({
+            'name': 'Test Shop',
+            'shop_url': 'test-shop.myshopify.com',
+            'api_key': 'key',
+            'api_secret': 'secret',
+        })
+        cls.Product = cls.env['shopify.product']
@@ -0,0 +1,37 @@
+from odoo.tests import tagged
+
+from .common import ShopifyTestCommon
+
+
+@tagged('post_install', '-at_install')
+class TestOrderSaleOrder(ShopifyTestCommon):
+
+    def test_generic_product_shared_by_lines(self):
+        order = self.env['shopify.order'].create({
+            'name': '#1001',
+            'shopify_id': '9001',
+            'instance_id': self.instance.id,
+            'email': 'buyer@example.com',
+            'line_ids': [(0, 0, {
+                'name': 'Qzx Unlisted Gadget',
+                'shopify_id': '9101',
+                'sku': 'QZX-UNKNOWN-1',
+                'quantity': 1,
+                'price': 12.0,
+            }), (0, 0, {
+                'name': 'Qzx Unlisted Gadget - Gift',
+                'shopify_id': '9102',
+                'sku': 'QZX-UNKNOWN-1',
+                'quantity': 2,
+                'price': 0.0,
+            })],
+        })
+
+        sale_order = order.create_sale_order()
+
+        products = sale_order.order_line.product_id
+        self.assertEqual(len(sale_order.order_line), 2)
+        self.assertEqual(len(products), 1)
+        self.assertEqual(products.default_code, 'QZX-UNKNOWN-1')
+        self.assertEqual(set(order.line_ids.mapped('match_method')), {'generic'})
+        self.assertEqual(self.env['product.product'].search_count([('default_code', '=', 'QZX-UNKNOWN-1')]), 1)
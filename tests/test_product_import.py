@@ -0,0 +1,105 @@
+import json
+from collections import Counter
+from datetime import datetime
+
+from odoo.exceptions import UserError
+from odoo.tests import tagged
+from odoo.tools import file_open
+
+from .common import ShopifyTestCommon
+
+
+@tagged('post_install', '-at_install')
+class TestProductBulkImport(ShopifyTestCommon):
+
+    def _read_fixture(self):
+        with file_open('shopify_integration/tests/data/bulk_products.jsonl', 'rb') as fixture:
+            return fixture.read().splitlines()
+
+    def test_import_bulk_jsonl(self):
+        watermark = self.Product._import_bulk_jsonl(self.instance, self._read_fixture())
+
+        products = self.Product.search([('instance_id', '=', self.instance.id)], order='shopify_id')
+        self.assertEqual(products.mapped('shopify_id'), ['1001', '1002'])
+        shirt, tote = products
+        self.assertEqual(shirt.name, 'Linen Shirt')
+        self.assertEqual(shirt.tags, 'linen, summer')
+        self.assertEqual(tote.status, 'draft')
+
+        variants = shirt.variant_ids.sorted('shopify_id')
+        self.assertEqual(variants.mapped('sku'), ['LS-S', 'LS-M'])
+        self.assertEqual(variants.mapped('inventory_item_id'), ['3001', '3002'])
+        self.assertEqual(variants[0].compare_at_price, 49.0)
+        self.assertEqual(variants[1].inventory_policy, 'continue')
+        self.assertEqual(shirt.image_ids.sorted('position').mapped('shopify_id'), ['4001', '4002'])
+        self.assertEqual(len(tote.variant_ids), 1)
+        self.assertFalse(tote.image_ids)
+
+        # The watermark is the latest product update of the file
+        self.assertEqual(watermark, (datetime(2024, 5, 3, 14, 15), 1002))
+
+    def test_import_bulk_jsonl_idempotent(self):
+        lines = self._read_fixture()
+        self.Product._import_bulk_jsonl(self.instance, lines)
+        stats = Counter()
+        self.Product._import_bulk_jsonl(self.instance, lines, stats)
+        self.assertEqual(stats['skipped'], 2)
+        self.assertEqual(self.Product.search_count([('instance_id', '=', self.instance.id)]), 2)
+
+    def test_orphan_child_raises(self):
+        lines = self._read_fixture()
+        # A variant whose product is not the one being reassembled
+        orphan = json.loads(lines[1])
+        orphan.update(id='gid://shopify/ProductVariant/2999', __parentId='gid://shopify/Product/1001')
+        lines.append(json.dumps(orphan).encode())
+        with self.assertRaises(UserError):
+            self.Product._import_bulk_jsonl(self.instance, lines)
+
+
+@tagged('post_install', '-at_install')
+class TestProductPageImport(ShopifyTestCommon):
+
+    def _product_page(self, size=250):
+        """Return a REST page of ``size`` products with two variants and two images each"""
+        return [{
+            'id': 5000 + index,
+            'title': f'Product {index}',
+            'handle': f'product-{index}',
+            'vendor': 'Acme',
+            'status': 'active',
+            'updated_at': '2024-05-01T12:00:00Z',
+            'variants': [{
+                'id': 60000 + index * 2 + position,
+                'title': size_name,
+                'price': '10.00',
+                'sku': f'SKU-{index}-{size_name}',
+                'inventory_item_id': 70000 + index * 2 + position,
+                'option1': size_name,
+            } for position, size_name in enumerate(['S', 'M'])],
+            'images': [{
+                'id': 80000 + index * 2 + position,
+                'position': position + 1,
+                'src': f'https://cdn.shopify.com/s/files/product-{index}-{position}.jpg',
+            } for position in range(2)],
+        } for index in range(size)]
+
+    def test_page_query_count(self):
+        page = self._product_page()
+        # The number of queries does not depend on the size of the page
+        with self.assertQueryCount(40):
+            self.Product._import_product_page(self.instance, page)
+
+        products = self.Product.search([('instance_id', '=', self.instance.id)])
+        self.assertEqual(len(products), 250)
+        self.assertEqual(len(products.variant_ids), 500)
+        self.assertEqual(len(products.image_ids), 500)
+
+    def test_unchanged_page_query_count(self):
+        page = self._product_page()
+        self.Product._import_product_page(self.instance, page)
+        self.env.invalidate_all()
+
+        stats = Counter()
+        with self.assertQueryCount(5):
+            self.Product._import_product_page(self.instance, page, stats)
+        self.assertEqual(stats['skipped'], 250)
@@ -1,5 +1,6 @@
 from odoo import models, fields, api, _
 from odoo.exceptions import UserError
+import json
 
 
 class ShopifyImportExportWizard(models.TransientModel):
@@ -73,7 +74,7 @@ class ShopifyImportExportWizard(models.TransientModel):
             'name': f"{self.operation.replace('_', ' ').title()} - {fields.Datetime.now()}",
             'instance_id': self.instance_id.id,
             'operation': self.operation,
-            'data': str(job_data),
+            'data': json.dumps(job_data),
             'state': 'queued',
             'priority': '2'
         })
@@ -125,56 +126,47 @@ class ShopifyImportExportWizard(models.TransientModel):
 
     def _export_products(self):
         """Export products to Shopify"""
+        self._get_export_products().export_to_shopify()
+
+    def _get_export_products(self):
+        """Return the Shopify products to export, creating the missing ones"""
+        ShopifyProduct = self.env['shopify.product']
         if self.export_all_products:
-            products = self.env['shopify.product'].search([
-                ('instance_id', '=', self.instance_id.id)
+            return ShopifyProduct.search([
+                ('instance_id', '=', self.instance_id.id),
+                ('product_id', '!=', False)
             ])
-        else:
-            if not self.product_ids:
-                raise UserError(_("Please select products to export"))
-
-            # Find or create shopify product records
-            products = self.env['shopify.product']
-            for product in self.product_ids:
-                shopify_product = self.env['shopify.product'].search([
-                    ('product_id', '=', product.id),
-                    ('instance_id', '=', self.instance_id.id)
-                ], limit=1)
-
-                if shopify_product:
-                    products |= shopify_product
-                else:
-                    # Create new shopify product record
-                    shopify_product = self.env['shopify.product'].create({
-                        'name': product.name,
-                        'shopify_id': '',
-                        'instance_id': self.instance_id.id,
-                        'product_id': product.id,
-                        'template_id': product.product_tmpl_id.id
-                    })
-                    products |= shopify_product
-
-        for product in products:
-            product.export_to_shopify()
 
-    def _sync_stock(self):
-        """Sync stock levels"""
-        products = self.env['shopify.product'].search([
+        if not self.product_ids:
+            raise UserError(_("Please select products to export"))
+
+        # Find or create shopify product records
+        products = ShopifyProduct.search([
+            ('product_id', 'in', self.product_ids.ids),
             ('instance_id', '=', self.instance_id.id)
         ])
+        linked = set(products.mapped('product_id').ids)
+        products |= ShopifyProduct.create([{
+            'name': product.name,
+            'shopify_id': '',
+            'instance_id': self.instance_id.id,
+            'product_id': product.id,
+            'template_id': product.product_tmpl_id.id
+        } for product in self.product_ids if product.id not in linked])
+        return products
 
-        for product in products:
-            product.sync_stock_levels()
+    def _sync_stock(self):
+        """Sync stock levels"""
+        self.env['shopify.stock.level'].sync_instance_stock(self.instance_id)
 
     def _sync_prices(self):
         """Sync prices"""
         products = self.env['shopify.product'].search([
             ('instance_id', '=', self.instance_id.id),
-            ('sync_required', '=', True)
+            ('price_sync_required', '=', True)
         ])
 
-        for product in products:
-            product.export_to_shopify()
+        products.sync_prices()
 
     def _prepare_job_data(self):
         """Prepare data for queue job"""
@@ -184,7 +176,7 @@ class ShopifyImportExportWizard(models.TransientModel):
             if self.export_all_products:
                 data['export_all'] = True
             else:
-                data['product_ids'] = self.product_ids.ids
+                data['product_ids'] = self._get_export_products().ids
 
         if self.operation == 'import_orders':
             if self.order_status != 'any':
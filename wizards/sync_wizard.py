@@ -1,5 +1,6 @@
 from odoo import models, fields, api, _
 from odoo.exceptions import UserError
+import json
 
 
 class ShopifySyncWizard(models.TransientModel):
@@ -72,6 +73,7 @@ class ShopifySyncWizard(models.TransientModel):
                 'name': f"Sync Products - {fields.Datetime.now()}",
                 'instance_id': self.instance_id.id,
                 'operation': 'import_products',
+                'data': json.dumps({'full_sync': self.force_update}),
                 'state': 'queued',
                 'priority': '2'
             })
@@ -130,7 +132,9 @@ class ShopifySyncWizard(models.TransientModel):
             results = []
 
             if self.sync_products:
-                self.env['shopify.product'].import_from_shopify(self.instance_id)
+                self.env['shopify.product'].import_from_shopify(
+                    self.instance_id, full_sync=self.force_update
+                )
                 results.append('Products synced')
 
             if self.sync_orders:
@@ -142,12 +146,8 @@ class ShopifySyncWizard(models.TransientModel):
                 results.append('Customers synced')
 
             if self.sync_stock:
-                products = self.env['shopify.product'].search([
-                    ('instance_id', '=', self.instance_id.id)
-                ])
-                for product in products:
-                    product.sync_stock_levels()
-                results.append('Stock levels synced')
+                stats = self.env['shopify.stock.level'].sync_instance_stock(self.instance_id)
+                results.append('Stock levels synced: %(pushed)s pushed, %(skipped)s unchanged' % stats)
 
             message = '\n'.join(results)
 